@@ -0,0 +1,356 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+import argparse
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+import digest
+import pipeline
+from pseudo import (Minwise, B_bit, Concatenated, J_hat, J_hat_from_conc,
+                    J_hat_from_bf, J_hat_from_bf_corrected)
+from set_like import BloomFilter, k_hashes
+from families import families
+from tabhash import SimpleTabulation
+
+"""
+Benchmarks of the hashing and comparison hot paths.
+
+Workloads of synthetic name and address records are generated from a
+fixed seed, with records repeated (with a skewed distribution) as in
+real registers, so that cache hit rates are meaningful. Each benchmark
+times its hot path (excluding set up) a number of times, reporting the
+best rate in records per second, the peak resident memory of the
+process running it and the hit rates of the caches involved.
+
+By default each benchmark runs in a fresh worker process, so that peak
+memory is not inflated by earlier benchmarks. Results can be saved as
+JSON (with the git commit and library versions) and compared with
+the results of another commit.
+
+Usage:
+
+    python bench.py --json results.json
+    python bench.py --compare results.json [--filter conc]
+"""
+
+FIRST = ['james', 'mary', 'john', 'patricia', 'robert', 'jennifer', 'michael',
+         'linda', 'william', 'elizabeth', 'david', 'susan', 'richard', 'jessica',
+         'joseph', 'sarah', 'thomas', 'karen', 'charles', 'nancy', 'mohammed',
+         'olivia', 'oliver', 'amelia', 'jack', 'isla', 'harry', 'ava', 'george']
+SURNAMES = ['smith', 'jones', 'williams', 'taylor', 'brown', 'davies', 'evans',
+            'wilson', 'thomas', 'johnson', 'roberts', 'robinson', 'thompson',
+            'wright', 'walker', 'white', 'edwards', 'hughes', 'green', 'hall',
+            'lewis', 'harris', 'clarke', 'patel', 'jackson', 'wood', 'turner']
+STREETS = ['high', 'station', 'main', 'park', 'church', 'london', 'victoria',
+           'green', 'manor', 'kings', 'queens', 'mill', 'school', 'north']
+SUFFIXES = ['street', 'road', 'lane', 'avenue', 'close', 'way', 'drive']
+
+def _misspell(s, rng):
+    # returns s with a random character substituted, deleted or transposed
+    i = rng.randrange(len(s))
+    op = rng.randrange(3)
+    if op == 0:
+        return s[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz') + s[i+1:]
+    if op == 1 and len(s) > 1:
+        return s[:i] + s[i+1:]
+    if i < len(s) - 1:
+        return s[:i] + s[i+1] + s[i] + s[i+2:]
+    return s
+
+def synthetic_records(count, seed=0, distinct=None, error_rate=0.1):
+    # returns a list of count records ('first surname, address'),
+    # drawn from distinct (by default count // 4) people with a
+    # skewed (Zipf-like) distribution, a proportion error_rate of
+    # records having a misspelled name
+    rng = random.Random(seed)
+    if distinct is None:
+        distinct = max(count // 4, 1)
+    people = ['%s %s, %d %s %s' % (rng.choice(FIRST), rng.choice(SURNAMES),
+                                   rng.randint(1, 200), rng.choice(STREETS),
+                                   rng.choice(SUFFIXES))
+              for _ in range(distinct)]
+    weights = np.cumsum(1 / np.arange(1, distinct + 1))
+    records = []
+    for _ in range(count):
+        person = people[int(np.searchsorted(weights, rng.random() * weights[-1]))]
+        if rng.random() < error_rate:
+            person = _misspell(person, rng)
+        records.append(person)
+    return records
+
+
+############## Benchmarks ##############
+
+# each benchmark is a function taking the records, their token sets
+# and a seed, and returning a tuple (run, caches) where run is a
+# callable (the timed hot path) returning the number of records
+# processed, and caches a dict of the caches it uses
+
+def _tabulation(q, klass=SimpleTabulation):
+    def bench(records, token_sets, seed):
+        h = klass(q, seed)
+        def run():
+            for tokens in token_sets:
+                for s in tokens:
+                    h.hash(s)
+            return len(token_sets)
+        return run, {'tabulation': h.cache}
+    return bench
+
+def _minwise(klass, m, *args):
+    def bench(records, token_sets, seed):
+        h = klass(*(args + (m, 64, seed)))
+        def run():
+            for tokens in token_sets:
+                h.hash(tokens)
+            return len(token_sets)
+        return run, {'signatures': h.cache}
+    return bench
+
+def _minwise_many(cls, m, *args, **kwargs):
+    def bench(records, token_sets, seed):
+        kwargs.setdefault('stacked', True)
+        h = cls(*(args + (m, 64, seed)), **kwargs)
+        def run():
+            h.hash_many(token_sets)
+            return len(token_sets)
+        return run, {'signatures': h.cache}
+    return bench
+
+def _bloom_add(m, k):
+    def bench(records, token_sets, seed):
+        funcs = k_hashes(k, m, seed)
+        def run():
+            for tokens in token_sets:
+                BloomFilter(m, funcs, tokens)
+            return len(token_sets)
+        return run, {'k_hashes': funcs[0].cache}
+    return bench
+
+def _bloom_contains(m, k):
+    def bench(records, token_sets, seed):
+        funcs = k_hashes(k, m, seed)
+        filters = [BloomFilter(m, funcs, tokens) for tokens in token_sets]
+        probes = token_sets[1:] + token_sets[:1]
+        def run():
+            for bf, tokens in zip(filters, probes):
+                for s in tokens:
+                    s in bf
+            return len(filters)
+        return run, {'k_hashes': funcs[0].cache}
+    return bench
+
+def _pairs(hashes):
+    # returns a list of pairs of consecutive hashes
+    return zip(hashes, hashes[1:] + hashes[:1])
+
+def _j_hat(m, b):
+    def bench(records, token_sets, seed):
+        pairs = _pairs(B_bit(b, m, seed=seed, stacked=True).hash_many(token_sets))
+        def run():
+            for x, y in pairs:
+                J_hat(x, y, b)
+            return len(pairs)
+        return run, {}
+    return bench
+
+def _j_hat_from_conc(m):
+    def bench(records, token_sets, seed):
+        pairs = _pairs(Concatenated(m, seed=seed, stacked=True).hash_many(token_sets))
+        def run():
+            for x, y in pairs:
+                J_hat_from_conc(x, y, m)
+            return len(pairs)
+        return run, {}
+    return bench
+
+def _j_hat_from_bf(m, k, corrected=False):
+    def bench(records, token_sets, seed):
+        funcs = k_hashes(k, m, seed)
+        pairs = _pairs([BloomFilter(m, funcs, tokens).bits for tokens in token_sets])
+        def run():
+            if corrected:
+                for x, y in pairs:
+                    J_hat_from_bf_corrected(x, y, m)
+            else:
+                for x, y in pairs:
+                    J_hat_from_bf(x, y)
+            return len(pairs)
+        return run, {}
+    return bench
+
+def _xor(m, N):
+    def bench(records, token_sets, seed):
+        hashes = Concatenated(m, seed=seed, stacked=True).hash_many(token_sets)
+        def run():
+            for h in hashes:
+                h.XOR(N)
+            return len(hashes)
+        return run, {}
+    return bench
+
+benchmarks = [('tabulation.hash q=%d' % q, _tabulation(q)) for q in SimpleTabulation.sizes]
+# hash families (see families)
+for name in sorted(families):
+    benchmarks += [('%s.hash q=64' % name, _tabulation(64, families[name])),
+                   ('Concatenated.hash_many m=256 %s' % name,
+                    _minwise_many(Concatenated, 256, klass=name, stacked=False))]
+for m in [16, 64, 256]:
+    benchmarks += [('Minwise.hash m=%d' % m, _minwise(Minwise, m)),
+                   ('B_bit.hash m=%d b=2' % m, _minwise(B_bit, m, 2)),
+                   ('Concatenated.hash m=%d' % m, _minwise(Concatenated, m)),
+                   ('Concatenated.hash_many m=%d' % m, _minwise_many(Concatenated, m))]
+benchmarks += [('BloomFilter.__init__ m=1000 k=10', _bloom_add(1000, 10)),
+               ('BloomFilter.__contains__ m=1000 k=10', _bloom_contains(1000, 10)),
+               ('J_hat m=256 b=2', _j_hat(256, 2)),
+               ('J_hat_from_conc m=1000', _j_hat_from_conc(1000)),
+               ('J_hat_from_bf m=1000 k=10', _j_hat_from_bf(1000, 10)),
+               ('J_hat_from_bf_corrected m=1000 k=10', _j_hat_from_bf(1000, 10, True)),
+               ('C_hash.XOR m=1024 N=2', _xor(1024, 2)),
+               ('C_hash.XOR m=1024 N=8', _xor(1024, 8))]
+
+
+############## Running ##############
+
+def _peak_kb():
+    # returns the peak resident memory of the process (in KB)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, KB elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def _hit_rate(stats):
+    lookups = stats['hits'] + stats['misses']
+    return stats['hits'] / lookups if lookups else None
+
+def run_benchmark(name, records=2000, seed=0, repeat=3):
+    # returns a dict of results for the named benchmark
+    bench = dict(benchmarks)[name]
+    data = synthetic_records(records, seed)
+    token_sets = [pipeline.tokens(record, 2, True) for record in data]
+    best = None
+    for _ in range(repeat):
+        # each repeat starts from cold caches
+        digest.shared.clear()
+        run, caches = bench(data, token_sets, seed)
+        start = time.time()
+        count = run()
+        seconds = time.time() - start
+        if best is None or seconds < best[0]:
+            best = (seconds, count, caches)
+    seconds, count, caches = best
+    return {'name': name,
+            'records': count,
+            'seconds': seconds,
+            'records_per_sec': count / seconds if seconds else float('inf'),
+            'peak_kb': _peak_kb(),
+            'cache_hit_rates': dict((key, _hit_rate(cache.stats()))
+                                    for key, cache in caches.items()),
+            'cache_nbytes': dict((key, cache.nbytes) for key, cache in caches.items())}
+
+def _run_isolated(args):
+    return run_benchmark(*args)
+
+def run(names=None, records=2000, seed=0, repeat=3, isolate=True):
+    # returns a list of results for the named benchmarks
+    # (by default all), each run in a fresh process if isolate is True
+    if names is None:
+        names = [name for name, bench in benchmarks]
+    results = []
+    for name in names:
+        if isolate:
+            pool = Pool(1)
+            try:
+                results.append(pool.apply(_run_isolated, ((name, records, seed, repeat),)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results.append(run_benchmark(name, records, seed, repeat))
+    return results
+
+def environment():
+    # returns a dict describing the commit and environment
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform()}
+
+def report(results, baseline=None, out=sys.stdout):
+    # writes a table of results (with the ratio of records/s
+    # to that of the baseline results, if given)
+    base = dict((r['name'], r) for r in (baseline or []))
+    out.write('%-48s %12s %10s %8s  %s\n' % ('benchmark', 'records/s', 'peak MB',
+                                             'ratio', 'cache hit rates'))
+    for r in results:
+        ratio = ''
+        if r['name'] in base:
+            ratio = '%.2f' % (r['records_per_sec'] / base[r['name']]['records_per_sec'])
+        rates = ', '.join('%s=%s' % (key, 'n/a' if rate is None else '%.3f' % rate)
+                          for key, rate in sorted(r['cache_hit_rates'].items()))
+        out.write('%-48s %12.0f %10.1f %8s  %s\n' % (r['name'], r['records_per_sec'],
+                                                     r['peak_kb'] / 1024, ratio, rates))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark hashing and comparison')
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--filter', help='run benchmarks whose names contain this string')
+    parser.add_argument('--no-isolate', dest='isolate', action='store_false')
+    parser.add_argument('--json', help='save results to this file')
+    parser.add_argument('--compare', help='compare with results saved in this file')
+    args = parser.parse_args(argv)
+    names = [name for name, bench in benchmarks
+             if args.filter is None or args.filter in name]
+    results = run(names, args.records, args.seed, args.repeat, args.isolate)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        if (saved['records'], saved['seed']) != (args.records, args.seed):
+            sys.stderr.write('Warning: baseline used different records or seed\n')
+        baseline = saved['results']
+    report(results, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'environment': environment(), 'records': args.records,
+                       'seed': args.seed, 'repeat': args.repeat,
+                       'results': results}, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,21 +21,44 @@
 
 from __future__ import division
 
-import math
+import numpy as np
+
+try:
+    import gmpy2 as _gmpy
+except ImportError:
+    try:
+        import gmpy as _gmpy
+    except ImportError:
+        _gmpy = None
 
 """
 A collection of functions for operating on bitstrings.
+
+Scalar functions operate on non-negative Python integers, using
+native integer operations (and gmpy, if available, for population
+counts). Array functions operate on bitstrings packed into numpy
+arrays of 64 bit words (as similarity.pack), the last axis indexing
+the words of each bitstring, and broadcast in the usual way, so that
+e.g. hamdist_many(a[:,None], b[None,:]) returns the matrix of
+Hamming distances between the rows of a and b.
 """
 
+M1 = np.uint64(0x5555555555555555)
+M2 = np.uint64(0x3333333333333333)
+M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+M8 = np.uint64(0x00ff00ff00ff00ff)
+H01 = np.uint64(0x0101010101010101)
+H0001 = np.uint64(0x0001000100010001)
+
 def digits(n, pad=None):
     """
-    Returns Python string representing I{n}.
+    Returns Python string representing I{n} (left padded
+    with 0-bits to length I{pad}).
     """
-    vals = [str(val) for val in iterbits(n)]
+    s = bin(n)[2:]
     if pad is not None:
-        vals.extend(['0']*(pad-len(vals)))
-    vals.reverse()
-    return ''.join(vals)
+        s = s.zfill(pad)
+    return s
 
 def getbit(n, i):
     """
@@ -48,7 +71,7 @@ def hamdist(x, y):
     Returns the Hamming distance (number of bit-positions
     where the bits differ) between I{x} and I{y}.
     """
-    return popcount(x ^ y)
+    return bin(x ^ y).count('1')
 
 def lowbits(n, i):
     """
@@ -56,31 +79,27 @@ def lowbits(n, i):
     """
     if not i > 0:
         raise ValueError, 'number of bits must be > 0'
-    res = 0
-    for ind, bit in enumerate(iterbits(n)):
-        if ind == i:
-            break
-        res += bit * 2**ind
-    return res
+    return n & ((1 << i) - 1)
 
 def numdigits(n):
     """
     Returns length of string representing I{n}.
     """
-    if n == 0:
-        return 1
-    else:
-        return int(math.log(n, 2)) + 1
+    return n.bit_length() or 1
 
 def popcount(n):
     """
     Returns the number of 1-bits set in I{n}.
     """
-    cnt = 0
-    while n:
-        n &= n - 1
-        cnt += 1
-    return cnt
+    return bin(n).count('1')
+
+# native versions (checked against gmpy below)
+_popcount = popcount
+_hamdist = hamdist
+
+if _gmpy is not None:
+    popcount = _gmpy.popcount
+    hamdist = _gmpy.hamdist
 
 def scan0(n, i=0):
     """
@@ -88,7 +107,7 @@ def scan0(n, i=0):
     is at least I{i}).
     """
     n = n >> i
-    return int(math.log((n ^ n+1) + 1, 2) - 1) + i
+    return (~n & (n + 1)).bit_length() - 1 + i
 
 def scan1(n, i=0):
     """
@@ -97,7 +116,7 @@ def scan1(n, i=0):
     """
     n = n >> i
     if n:
-        return int(math.log(n & -n, 2)) + i
+        return (n & -n).bit_length() - 1 + i
     else:
         return None
 
@@ -126,13 +145,65 @@ def iterbits(n):
         yield n & 1
         n = n >> 1
 
+def _byte_counts(words):
+    # returns the number of set bits in each byte
+    # of an array of 64 bit words (SWAR)
+    x = words - ((words >> np.uint64(1)) & M1)
+    x = (x & M2) + ((x >> np.uint64(2)) & M2)
+    x += x >> np.uint64(4)
+    x &= M4
+    return x
+
+def popcount_words(words):
+    """
+    Returns the number of 1-bits set in each word of
+    I{words}, an array of 64 bit words.
+    """
+    return (_byte_counts(words) * H01) >> np.uint64(56)
+
+def popcount_array(packed):
+    """
+    Returns an int64 array of the number of 1-bits set in
+    each bitstring of I{packed}.
+    """
+    x = _byte_counts(np.asarray(packed, dtype=np.uint64))
+    res = np.zeros(x.shape[:-1], dtype=np.int64)
+    # byte counts (at most 8) are summed over up to 31 words
+    # without overflowing, then over the bytes of the sums
+    for i in range(0, x.shape[-1], 31):
+        s = x[...,i:i+31].sum(axis=-1, dtype=np.uint64)
+        s = (s & M8) + ((s >> np.uint64(8)) & M8)
+        res += ((s * H0001) >> np.uint64(48)).astype(np.int64)
+    return res
+
+def hamdist_many(a, b):
+    """
+    Returns an int64 array of the Hamming distances
+    between the bitstrings of I{a} and I{b}.
+    """
+    return popcount_array(a ^ b)
+
+def and_popcount(a, b):
+    """
+    Returns an int64 array of the number of 1-bits set in
+    the intersections of the bitstrings of I{a} and I{b}.
+    """
+    return popcount_array(a & b)
+
+def or_popcount(a, b):
+    """
+    Returns an int64 array of the number of 1-bits set in
+    the unions of the bitstrings of I{a} and I{b}.
+    """
+    return popcount_array(a | b)
+
 
 if __name__ == '__main__':
     try:
         import gmpy
     except ImportError:
-        pass
-    else:
+        gmpy = None
+    if gmpy is not None:
         ints = range(400)
         for n in ints:
             try:
@@ -146,7 +217,7 @@ if __name__ == '__main__':
                 print 'numdigits fail %d' % n
                 raise
             try:
-                assert gmpy.popcount(n) == popcount(n)
+                assert gmpy.popcount(n) == _popcount(n)
             except AssertionError:
                 print 'popcount fail %d' % n
                 raise
@@ -168,7 +239,7 @@ if __name__ == '__main__':
                     print 'lowbits fail %d', n
                     raise
                 try:
-                    assert gmpy.hamdist(n, i) == hamdist(n, i)
+                    assert gmpy.hamdist(n, i) == _hamdist(n, i)
                 except AssertionError:
                     print 'hamdist fail %d', n
                     raise
@@ -188,6 +259,47 @@ if __name__ == '__main__':
                     print 'scan0 fail %d', n
                     raise
         assert scan1(0) is None
+        # large values
+        rand = np.random.RandomState(0)
+        for bits in [63, 64, 65, 1000, 4096]:
+            for _ in range(50):
+                n = int(''.join(str(b) for b in rand.randint(0, 2, bits)), 2)
+                i = rand.randint(0, bits)
+                try:
+                    assert gmpy.digits(n, 2) == digits(n)
+                    assert gmpy.numdigits(n, 2) == numdigits(n)
+                    assert gmpy.popcount(n) == _popcount(n)
+                    assert gmpy.hamdist(n, n >> 1) == _hamdist(n, n >> 1)
+                    assert gmpy.lowbits(n, i + 1) == lowbits(n, i + 1)
+                    assert gmpy.scan0(n, i) == scan0(n, i)
+                    assert gmpy.scan1(n, i) == scan1(n, i)
+                except AssertionError:
+                    print 'large value fail %d, %d' % (n, i)
+                    raise
+    # array functions against the scalar functions
+    # (verified above against gmpy, if available)
+    from binascii import hexlify
+    def to_long(row):
+        return int(hexlify(row.astype('>u8').tobytes()), 16) if len(row) else 0
+    rand = np.random.RandomState(1)
+    for nwords in [0, 1, 2, 30, 31, 32, 63, 100]:
+        a = rand.randint(0, 2**63, (20, nwords)).astype(np.uint64) * np.uint64(2)
+        a ^= rand.randint(0, 2, (20, nwords)).astype(np.uint64)
+        a[0] = ~np.uint64(0)
+        b = a[::-1] & rand.randint(0, 2**63, (20, nwords)).astype(np.uint64)
+        a_longs = [to_long(row) for row in a]
+        b_longs = [to_long(row) for row in b]
+        try:
+            assert popcount_array(a).tolist() == [_popcount(x) for x in a_longs]
+            assert (popcount_words(a).sum(axis=-1) == popcount_array(a)).all()
+            assert hamdist_many(a, b).tolist() == [_hamdist(x, y) for x, y in zip(a_longs, b_longs)]
+            assert and_popcount(a, b).tolist() == [_popcount(x & y) for x, y in zip(a_longs, b_longs)]
+            assert or_popcount(a, b).tolist() == [_popcount(x | y) for x, y in zip(a_longs, b_longs)]
+            assert hamdist_many(a[:,None], b[None,:]).tolist() == [[_hamdist(x, y) for y in b_longs]
+                                                                   for x in a_longs]
+        except AssertionError:
+            print 'array fail %d words' % nwords
+            raise
 
 
 
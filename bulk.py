@@ -0,0 +1,242 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+import argparse
+import csv
+import logging
+import sys
+import time
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+import keyfile
+import pipeline
+from families import families
+from sigcache import SignatureCache
+from pseudo import Minwise, B_bit, Concatenated
+from set_like import k_hashes, BloomFilter
+
+"""
+Bulk pseudonymization of line-delimited or CSV files.
+
+Records are tokenized into n-grams and hashed by a pool of worker
+processes, each of which loads (memory maps) the same key file and so
+hashes identically. Output is written in input order: concatenated
+hashes and Bloom filters as fixed width hex strings, and lists of
+(b-bit) minwise hashes as space separated integers. Records with no
+tokens are written as empty strings (with a warning).
+
+Usage:
+
+    python bulk.py keygen KEYFILE --kind conc --m 1000 --seed 42
+    python bulk.py run KEYFILE INPUT OUTPUT [--csv --field surname --header]
+                       [--cache CACHEFILE]
+"""
+
+logger = logging.getLogger(__name__)
+
+_worker = {}
+
+def make_hasher(kind, m, q=64, b=1, k=None, seed=None, klass='SimpleTabulation'):
+    # returns a new hasher of the given kind
+    # ('minwise', 'bbit', 'conc' or 'bloom') using
+    # the hash family klass (see families)
+    if kind == 'minwise':
+        return Minwise(m, q, seed, klass)
+    if kind == 'bbit':
+        return B_bit(b, m, q, seed, klass=klass)
+    if kind == 'conc':
+        return Concatenated(m, q, seed, klass=klass)
+    if kind == 'bloom':
+        return k_hashes(k, m, seed, klass=klass)
+    raise ValueError('Unknown kind of hasher %s' % kind)
+
+def load_hasher(key_path):
+    # returns a hasher (with a hash_many method)
+    # for the key material in key_path
+    hasher = keyfile.load(key_path, stacked=True)
+    if isinstance(hasher, list):
+        return pipeline.BloomHasher(hasher[0].params['m'], hasher)
+    return hasher
+
+def format_hash(h):
+    # returns a string representation of a hash
+    if isinstance(h, BloomFilter):
+        return '%0*x' % (-(-h.m // 4), h.bits)
+    if isinstance(h, (int, long)):
+        return '%0*x' % (-(-h.m // 4), h)
+    return ' '.join(str(x) for x in h)
+
+def _init_worker(key_path, n, pad, positional, cache_path=None):
+    _worker['hasher'] = load_hasher(key_path)
+    _worker['options'] = (n, pad, positional)
+    _worker['cache'] = None
+    if cache_path is not None:
+        _worker['cache'] = SignatureCache(cache_path, _worker['hasher'], readonly=True)
+
+def _hash_chunk(records):
+    # returns the formatted hashes of the records and the
+    # signature cache rows for those that were computed
+    # records with no tokens (e.g. single characters without
+    # padding) cannot be hashed, and get an empty string
+    n, pad, positional = _worker['options']
+    token_sets = pipeline.tokenize_many(records, n, pad, positional)
+    nonempty = [tokens for tokens in token_sets if tokens]
+    if _worker['cache'] is None:
+        hashes, rows = _worker['hasher'].hash_many(nonempty), []
+    else:
+        hashes, rows = _worker['cache'].lookup(nonempty)
+    hashes = iter(hashes)
+    return [format_hash(next(hashes)) if tokens else '' for tokens in token_sets], rows
+
+def pseudonymize(source, dest, key_path, n=2, pad=True, positional=False,
+                 field=None, delimiter=',', header=False,
+                 chunk_size=1000, processes=None, cache_path=None):
+    # pseudonymizes the records in file source, writing the
+    # hashes to file dest, and returns a dict of statistics
+    # if field is None, then each line is a record, otherwise
+    # the input is CSV and the given field (name, if header
+    # is True, or index) is replaced by its hash
+    # chunk_size records are sent to each worker at a time,
+    # and processes is the number of workers (by default the
+    # number of CPUs)
+    # if cache_path is not None, then signatures are looked up in
+    # (by the workers) and added to (by this process) the
+    # persistent signature cache at cache_path
+    start = time.time()
+    count = 0
+    empty = 0
+    computed = [0]
+    if processes is None:
+        processes = cpu_count()
+    cache = None
+    if cache_path is not None:
+        # creates the database before the workers open it
+        cache = SignatureCache(cache_path, load_hasher(key_path))
+    def store(rows):
+        computed[0] += len(rows)
+        if cache is not None and rows:
+            cache.put_rows(rows)
+    pool = Pool(processes, _init_worker, (key_path, n, pad, positional, cache_path))
+    try:
+        with open(source, 'rb' if field is not None else 'r') as fin:
+            with open(dest, 'wb' if field is not None else 'w') as fout:
+                if field is None:
+                    rows = pipeline.read_records(fin)
+                    col = None
+                    write = lambda row, h: fout.write(h + '\n')
+                else:
+                    reader = csv.reader(fin, delimiter=delimiter)
+                    writer = csv.writer(fout, delimiter=delimiter, lineterminator='\n')
+                    col = field
+                    if header:
+                        names = next(reader)
+                        writer.writerow(names)
+                        if not isinstance(field, int):
+                            col = names.index(field)
+                    if not isinstance(col, int):
+                        raise ValueError('Field names require a header row')
+                    rows = reader
+                    def write(row, h):
+                        row[col] = h
+                        writer.writerow(row)
+                # at most two chunks per worker are in flight,
+                # so memory use is bounded
+                pending = deque()
+                for chunk in pipeline.batched(rows, chunk_size):
+                    records = chunk if col is None else [row[col] for row in chunk]
+                    pending.append((chunk, pool.apply_async(_hash_chunk, (records,))))
+                    if len(pending) >= 2 * processes:
+                        count, empty = _write_chunk(pending.popleft(), write, store, count, empty)
+                while pending:
+                    count, empty = _write_chunk(pending.popleft(), write, store, count, empty)
+    finally:
+        pool.close()
+        pool.join()
+        if cache is not None:
+            cache.close()
+    seconds = time.time() - start
+    if cache_path is None:
+        computed[0] = count - empty
+    return {'records': count, 'seconds': seconds, 'computed': computed[0], 'empty': empty,
+            'records_per_sec': count / seconds if seconds else float('inf')}
+
+def _write_chunk(item, write, store, count, empty):
+    # writes a chunk of hashes, returning the updated counts
+    # of records and of empty (unhashable) records
+    chunk, result = item
+    hashes, rows = result.get()
+    for i, (row, h) in enumerate(zip(chunk, hashes)):
+        if not h:
+            logger.warning('Record %d has no tokens, so its hash is empty', count + i + 1)
+            empty += 1
+        write(row, h)
+    store(rows)
+    return count + len(hashes), empty
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk string pseudonymization')
+    sub = parser.add_subparsers(dest='command')
+    gen = sub.add_parser('keygen', help='generate a key file')
+    gen.add_argument('key')
+    gen.add_argument('--kind', choices=['minwise', 'bbit', 'conc', 'bloom'], default='conc')
+    gen.add_argument('--m', type=int, required=True)
+    gen.add_argument('--q', type=int, default=64)
+    gen.add_argument('--b', type=int, default=1)
+    gen.add_argument('--k', type=int, default=10)
+    gen.add_argument('--seed', type=int)
+    gen.add_argument('--family', choices=sorted(families), default='SimpleTabulation')
+    run = sub.add_parser('run', help='pseudonymize a file')
+    run.add_argument('key')
+    run.add_argument('input')
+    run.add_argument('output')
+    run.add_argument('-n', type=int, default=2)
+    run.add_argument('--no-pad', dest='pad', action='store_false')
+    run.add_argument('--positional', action='store_true')
+    run.add_argument('--csv', action='store_true')
+    run.add_argument('--field', default='0')
+    run.add_argument('--delimiter', default=',')
+    run.add_argument('--header', action='store_true')
+    run.add_argument('--chunk-size', type=int, default=1000)
+    run.add_argument('--processes', type=int)
+    run.add_argument('--cache', help='persistent signature cache (sqlite) file')
+    args = parser.parse_args(argv)
+    if args.command == 'keygen':
+        hasher = make_hasher(args.kind, args.m, args.q, args.b, args.k, args.seed, args.family)
+        keyfile.save(hasher, args.key)
+        return
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+    field = None
+    if args.csv:
+        field = int(args.field) if args.field.isdigit() else args.field
+    stats = pseudonymize(args.input, args.output, args.key, args.n, args.pad,
+                         args.positional, field, args.delimiter, args.header,
+                         args.chunk_size, args.processes, args.cache)
+    sys.stderr.write('%(records)d records in %(seconds).2f s '
+                     '(%(records_per_sec).0f records/s)\n' % stats)
+    if stats['empty']:
+        sys.stderr.write('%(empty)d records with no tokens were left empty\n' % stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+import sys
+from collections import OrderedDict, deque
+
+"""
+Bounded caches for hash values.
+
+The hashers (and Bloom filter hash functions) look values up with
+get() (None signalling a miss) and store them with item assignment,
+so any of the classes below can be used interchangeably.
+
+BoundedCache (the default for the hashers) holds its items in a
+plain dict, and so costs little more than a dict on a hit. LRUCache
+reorders its items on every hit, which is slower, and should be
+chosen (as a cache_factory) only where recency matters.
+"""
+
+_missing = object()
+
+def sizeof(obj):
+    """
+    Returns an estimate of the number of bytes held by I{obj},
+    including the elements of (unnested) containers.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list, set, frozenset)):
+        size += sum(sys.getsizeof(x) for x in obj)
+    return size
+
+
+class BoundedCache(object):
+    # cache holding at most maxsize items and (approximately)
+    # maxbytes bytes (a bound of None means unbounded)
+    # the oldest items (in order of insertion) are evicted first
+    def __init__(self, maxsize=None, maxbytes=None, sizeof=sizeof):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._sizeof = sizeof
+        self._data = self._new_data()
+        # keys in order of insertion (if bounded)
+        self._order = deque()
+        self._bounded = maxsize is not None or maxbytes is not None
+        self._sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _new_data(self):
+        return {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        # returns the cached value for key, or default
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        data = self._data
+        new = not key in data
+        if not new and self.maxbytes is not None:
+            self.nbytes -= self._sizes.pop(key, 0)
+        data[key] = value
+        if self.maxbytes is not None:
+            size = self._sizeof(key) + self._sizeof(value)
+            self._sizes[key] = size
+            self.nbytes += size
+        if self._bounded:
+            if new:
+                self._track(key)
+            self._evict()
+
+    def _track(self, key):
+        self._order.append(key)
+
+    def _evict(self):
+        # evicts the oldest items while the cache exceeds its bounds
+        data = self._data
+        while data and ((self.maxsize is not None and len(data) > self.maxsize) or
+                        (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+            self._discard(self._oldest())
+            self.evictions += 1
+
+    def _oldest(self):
+        return self._order.popleft()
+
+    def _discard(self, key):
+        del self._data[key]
+        self.nbytes -= self._sizes.pop(key, 0)
+
+    def clear(self):
+        self._data.clear()
+        self._order.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+
+    def estimated_nbytes(self):
+        # returns the (estimated) number of bytes held by the items
+        # (tracked if maxbytes is not None, otherwise computed)
+        if self.maxbytes is not None:
+            return self.nbytes
+        return sum(self._sizeof(key) + self._sizeof(value) for key, value in self._data.items())
+
+    def stats(self):
+        # returns a dict of cache statistics
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self),
+                'nbytes': self.nbytes,
+                'maxsize': self.maxsize,
+                'maxbytes': self.maxbytes}
+
+
+class LRUCache(BoundedCache):
+    # bounded cache evicting the least recently used items first
+    # (items are held in an OrderedDict, reordered on every hit)
+    def _new_data(self):
+        return OrderedDict()
+
+    def get(self, key, default=None):
+        value = self._data.pop(key, _missing)
+        if value is _missing:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            self._discard(key)
+        super(LRUCache, self).__setitem__(key, value)
+
+    def _track(self, key):
+        pass
+
+    def _oldest(self):
+        return next(iter(self._data))
+
+
+class NullCache(BoundedCache):
+    # cache that stores nothing (for disabling caching)
+    def __init__(self, *args, **kwargs):
+        super(NullCache, self).__init__(maxsize=0)
+
+    def __setitem__(self, key, value):
+        pass
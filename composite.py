@@ -0,0 +1,129 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+import numpy as np
+
+from set_like import k_hashes, ArrayBloomFilter, _set_indices, _to_long
+from tokenization import n_grams
+
+"""
+Record-level (composite) Bloom filter encoding.
+
+Each field of a record is tokenized into n-grams, and the tokens,
+prefixed by the field name (so that equal n-grams in different fields
+are distinct tokens), are added to a single Bloom filter of length m.
+Fields are weighted by the number of hash functions k used for their
+tokens. The hash functions are those of a single k_hashes call (with
+k the largest field weight), a field of weight k using the first k,
+so each distinct token is hashed once per batch (by the two underlying
+tabulation hashes) whatever its weight.
+"""
+
+SEP = '\x00'
+
+class CompositeBloomEncoder(object):
+    # encoder of records as composite Bloom filters of length m
+    # fields is a list of (name, k) tuples, giving the weight
+    # (number of hash functions) of each field
+    # a record is a dict (keyed by field name) or a sequence
+    # of field values (in the order of fields), missing (None)
+    # and empty values contributing no tokens
+    # funcs is a list of (at least max(k)) hash functions returned
+    # by k_hashes, generated (with the given seed) if funcs is None
+    def __init__(self, m, fields, n=2, pad=True, funcs=None, seed=None):
+        self.m = m
+        self.fields = [(name, k) for name, k in fields]
+        if not all(k >= 0 for name, k in self.fields):
+            raise ValueError('Field weights must be non-negative')
+        if not any(k > 0 for name, k in self.fields):
+            raise ValueError('At least one field weight must be positive')
+        self.n = n
+        self.pad = pad
+        if funcs is None:
+            funcs = k_hashes(max(k for name, k in self.fields), m, seed)
+        if len(funcs) < max(k for name, k in self.fields):
+            raise ValueError('Too few hash functions for field weights')
+        self.funcs = funcs
+        self._hash1, self._hash2 = funcs[0].hashers
+
+    def tokens(self, record):
+        # returns a list of (token, k) tuples for the
+        # field-prefixed tokens of record
+        res = []
+        for j, (name, k) in enumerate(self.fields):
+            value = record.get(name) if isinstance(record, dict) else record[j]
+            if not value or not k:
+                continue
+            prefix = name + SEP
+            res.extend((prefix + gram, k) for gram in set(n_grams(value, self.n, self.pad)))
+        return res
+
+    def encode_array(self, records):
+        # returns an (n, bytes) uint8 array of the Bloom filters
+        # for the n records in records (bit i of each in bit i % 8
+        # of byte i // 8, as ArrayBloomFilter)
+        records = list(records)
+        nbytes = -(-self.m // 8)
+        index = {}
+        rows, cols, ks = [], [], []
+        for r, record in enumerate(records):
+            for token, k in self.tokens(record):
+                rows.append(r)
+                cols.append(index.setdefault(token, len(index)))
+                ks.append(k)
+        res = np.zeros((len(records), nbytes), dtype=np.uint8)
+        if not index:
+            return res
+        strings = sorted(index, key=index.get)
+        mod = np.uint64(self.m)
+        h1 = self._hash1.hash_many(strings).astype(np.uint64) % mod
+        h2 = self._hash2.hash_many(strings).astype(np.uint64) % mod
+        # expand each (record, token) pair to its k hash indices
+        ks = np.array(ks, dtype=np.int64)
+        starts = np.cumsum(ks) - ks
+        i = (np.arange(ks.sum()) - np.repeat(starts, ks)).astype(np.uint64)
+        cols = np.repeat(np.array(cols, dtype=np.int64), ks)
+        rows = np.repeat(np.array(rows, dtype=np.int64), ks)
+        # (h1 + i*h2) % m, without overflow (as BloomFilter._indices)
+        indices = ((h1[cols] + (i * h2[cols]) % mod) % mod).astype(np.int64)
+        _set_indices(res.ravel(), rows * (nbytes * 8) + indices)
+        return res
+
+    def encode_many(self, records, klass=ArrayBloomFilter):
+        # returns a list of Bloom filters (of type klass) for the
+        # records in records, computed as a single batch
+        # (the filters' funcs are those of the encoder, so
+        # membership tests use max(k) hash functions)
+        res = []
+        for arr in self.encode_array(records):
+            bf = klass(self.m, self.funcs)
+            if isinstance(bf, ArrayBloomFilter):
+                bf.array = arr
+            else:
+                bf.bits = _to_long(arr)
+            res.append(bf)
+        return res
+
+    def encode(self, record, klass=ArrayBloomFilter):
+        # returns the Bloom filter for a single record
+        return self.encode_many([record], klass)[0]
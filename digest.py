@@ -0,0 +1,166 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+import hashlib
+import hmac
+from hashlib import md5
+
+import numpy as np
+
+import instrument
+
+"""
+Shared table of token digests.
+
+Each distinct token is digested (md5) once per process and assigned
+an integer id, the 128 bit digests being held in a single array.
+Tabulation hashes look up intermediate keys by id, so neither digest
+computation nor memory scales with the number of hash functions.
+
+Keyed tables (see keyed) hold 128 bit keyed digests: blake2b (keyed)
+where hashlib provides it, and otherwise HMAC-SHA256 truncated to
+128 bits.
+"""
+
+
+class DigestTable(object):
+    # intern table mapping tokens to ids and
+    # holding their md5 digests in an (n, 16) array
+    # if maxsize is not None, then the table is cleared
+    # (invalidating all ids) before it would exceed maxsize
+    # tokens, so ids should only be held for the duration
+    # of a batch
+    # if secret is not None, then tokens are digested with a keyed
+    # hash (see keyed_digest) rather than md5
+    def __init__(self, maxsize=2**20, secret=None):
+        self.maxsize = maxsize
+        self.secret = secret
+        self._digest = md5_digest if secret is None else keyed_digest(secret)
+        self._ids = {}
+        self._digests = np.empty((1024, 16), dtype=np.uint8)
+        self.digested = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, s):
+        return s in self._ids
+
+    def clear(self):
+        self._ids.clear()
+
+    def _reserve(self, n):
+        # ensures there is room for n new tokens
+        # (clearing the table if it would exceed maxsize)
+        if self.maxsize is not None and len(self._ids) + n > self.maxsize:
+            self.clear()
+        self._grow(len(self._ids) + n)
+
+    def _grow(self, size):
+        if size > len(self._digests):
+            digests = np.empty((max(size, 2 * len(self._digests)), 16), dtype=np.uint8)
+            digests[:len(self._ids)] = self._digests[:len(self._ids)]
+            self._digests = digests
+
+    def id(self, s):
+        # returns the id of token s
+        try:
+            return self._ids[s]
+        except KeyError:
+            self._reserve(1)
+            i = len(self._ids)
+            self._digests[i] = np.frombuffer(self._digest(s), dtype=np.uint8)
+            self._ids[s] = i
+            self.digested += 1
+            return i
+
+    def ids(self, strings):
+        # returns an array of the ids of the tokens in strings
+        strings = list(strings)
+        ids = self._ids
+        new = set(s for s in strings if not s in ids)
+        if new:
+            self._reserve(len(new))
+            new = [s for s in set(strings) if not s in ids]
+            start = len(ids)
+            self._grow(start + len(new))
+            with instrument.timed('digest', len(new)):
+                digest = self._digest
+                buf = b''.join([digest(s) for s in new])
+                self._digests[start:start+len(new)] = np.frombuffer(buf, dtype=np.uint8).reshape(-1, 16)
+            for i, s in enumerate(new):
+                ids[s] = start + i
+            self.digested += len(new)
+        return np.array([ids[s] for s in strings], dtype=np.int64)
+
+    def key(self, i, q=64):
+        # returns the intermediate key bytes for token id i as a
+        # bytearray, least significant byte first (so that byte j
+        # indexes table j of a SimpleTabulation with hash size q)
+        key = bytearray(self._digests[i,:q//8].tobytes())
+        key.reverse()
+        return key
+
+    def key_of(self, s, q=64):
+        # returns the intermediate key bytes for token s (as for
+        # key), digesting s without adding it to the table
+        key = bytearray(self._digest(s)[:q//8])
+        key.reverse()
+        return key
+
+    def key_bytes(self, ids, q=64):
+        # returns an (n, q//8) uint8 array of the intermediate
+        # keys for an array of n ids (bytes ordered as for key)
+        return self._digests[ids,:q//8][:,::-1]
+
+    def nbytes(self):
+        # returns the number of bytes held in the digest array
+        return self._digests.nbytes
+
+
+def md5_digest(s):
+    return md5(s).digest()
+
+def keyed_digest(secret):
+    # returns a function returning the 128 bit keyed digest of
+    # a string (blake2b if available, otherwise truncated
+    # HMAC-SHA256) using secret (at most 64 bytes)
+    if hasattr(hashlib, 'blake2b'):
+        blake2b = hashlib.blake2b
+        return lambda s: blake2b(s, digest_size=16, key=secret).digest()
+    sha256 = hashlib.sha256
+    return lambda s: hmac.new(secret, s, sha256).digest()[:16]
+
+
+# table shared by all tabulation hashes in the process
+shared = DigestTable()
+
+_keyed = {}
+
+def keyed(secret):
+    # returns the table of keyed digests for secret
+    # (shared by all hashes in the process using it)
+    table = _keyed.get(secret)
+    if table is None:
+        table = _keyed[secret] = DigestTable(secret=secret)
+    return table
@@ -0,0 +1,257 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+import functools
+
+import numpy as np
+
+import digest
+import instrument
+from cache import BoundedCache
+from tabhash import SimpleTabulation, ExactTabulation, random_stream, random_tables
+
+"""
+Families of hash functions for strings, usable by Minwise (and its
+subclasses) and k_hashes (as klass, or by name in families).
+
+Each class has the interface of SimpleTabulation: a hash method,
+whole-array hash_many and hash_ids methods (the latter taking ids in
+the instance's digests table), a hash size q (8, 16, 32 or 64),
+construction from a seed stream (from_seed) and persistence of key
+material (key_arrays and from_key).
+
+Independence properties (for the intermediate keys, i.e. digests,
+of distinct tokens, which are distinct with overwhelming probability):
+
+    SimpleTabulation    3-independent; minwise hashing with it has
+                        bias O(1/|S|) (Patrascu and Thorup, 2012)
+    KeyedTabulation     as SimpleTabulation, the intermediate keys
+                        being keyed digests, so that they cannot be
+                        computed (e.g. for a dictionary of tokens)
+                        without the secret
+    TwistedTabulation   3-independent, with Chernoff-type concentration
+                        and minwise bias O(1/|S|) with better constants
+                        for small sets (Patrascu and Thorup, 2013)
+    MultiplyShift       2-independent (strongly universal) on 32 bit
+                        intermediate keys (Dietzfelbinger, 1996); cheapest,
+                        but 2-independence does not bound the minwise bias
+                        in general, and distinct tokens collide on the
+                        32 bit key with probability 2**-32
+    ExactTabulation     as SimpleTabulation, but indexing the tables of
+                        q=64 hashes with the exact intermediate key
+                        bytes (SimpleTabulation keeps the rounded keys
+                        of earlier versions, see tabhash)
+
+All but KeyedTabulation share the md5 digest table (digest.shared),
+so each token is digested once per process whichever of them is used.
+"""
+
+class KeyedTabulation(SimpleTabulation):
+    # simple tabulation hash of keyed (blake2b or HMAC-SHA256)
+    # digests, the secret being part of the key material
+    # hashes generated from the same seed share the secret,
+    # and so the table of digests
+    # (having no earlier hashes to reproduce, it uses exact keys)
+    exact_keys = True
+    def __init__(self, q=64, seed=None, secret=None):
+        super(KeyedTabulation, self).__init__(q, seed)
+        if secret is None:
+            rng = np.random.RandomState() if seed is None else random_stream(seed, 3)
+            secret = rng.bytes(32)
+        self._set_secret(secret)
+
+    def _set_secret(self, secret):
+        self.secret = bytes(secret)
+        self.digests = digest.keyed(self.secret)
+
+    @classmethod
+    def from_seed(cls, q, seed, *path):
+        obj = cls.from_tables(random_tables(q, random_stream(seed, *path)))
+        obj._set_secret(random_stream(seed, 3).bytes(32))
+        return obj
+
+    @classmethod
+    def from_key(cls, q, arrays):
+        obj = super(KeyedTabulation, cls).from_key(q, arrays)
+        obj._set_secret(np.asarray(arrays['secret'], dtype=np.uint8).tobytes())
+        return obj
+
+    def key_arrays(self):
+        return {'tables': self.tables,
+                'secret': np.frombuffer(self.secret, dtype=np.uint8)}
+
+
+class TwistedTabulation(SimpleTabulation):
+    # twisted tabulation hash (Patrascu and Thorup, 2013)
+    # for the c = q//8 bytes x_0, ..., x_{c-1} of the intermediate
+    # key, the hash is T_{c-1}[x_{c-1} ^ t] ^ T_0[x_0] ^ ... ^ T_{c-2}[x_{c-2}]
+    # where the twist t = U_0[x_0] ^ ... ^ U_{c-2}[x_{c-2}] for
+    # random tables U of bytes (for q=8 it is simple tabulation)
+    # (having no earlier hashes to reproduce, it uses exact keys)
+    exact_keys = True
+    def __init__(self, q=64, seed=None):
+        super(TwistedTabulation, self).__init__(q, seed)
+        rng = np.random.RandomState() if seed is None else random_stream(seed, 4)
+        self.twisters = self._random_twisters(q, rng)
+
+    @staticmethod
+    def _random_twisters(q, rng):
+        return rng.randint(0, 256, size=(q//8 - 1, 256), dtype=np.uint8)
+
+    @classmethod
+    def from_seed(cls, q, seed, *path):
+        rng = random_stream(seed, *path)
+        obj = cls.from_tables(random_tables(q, rng))
+        obj.twisters = cls._random_twisters(q, rng)
+        return obj
+
+    @classmethod
+    def from_key(cls, q, arrays):
+        obj = super(TwistedTabulation, cls).from_key(q, arrays)
+        if not arrays['twisters'].shape == (q//8 - 1, 256):
+            raise ValueError('Key material does not match parameters')
+        obj.twisters = np.asarray(arrays['twisters'], dtype=np.uint8)
+        return obj
+
+    def key_arrays(self):
+        return {'tables': self.tables, 'twisters': self.twisters}
+
+    def _hash_key(self, key):
+        try:
+            rows, twisters = self._rows, self._twister_rows
+        except AttributeError:
+            rows = self._rows = self.tables.tolist()
+            twisters = self._twister_rows = self.twisters.tolist()
+        h = t = 0
+        for row, twister, c in zip(rows, twisters, key[:-1]):
+            h ^= row[c]
+            t ^= twister[c]
+        return h ^ rows[-1][key[-1] ^ t]
+
+    def tabulate(self, keys):
+        keys = np.asarray(keys, dtype=np.uint8)
+        with instrument.timed('tabulate', len(keys)):
+            c = self.tables.shape[0]
+            cols = np.arange(c - 1)
+            h = np.bitwise_xor.reduce(self.tables[cols,keys[:,:-1]], axis=1)
+            t = np.bitwise_xor.reduce(self.twisters[cols,keys[:,:-1]], axis=1)
+            return h ^ self.tables[c-1,keys[:,-1] ^ t]
+
+
+class MultiplyShift(object):
+    # multiply-add-shift hash (Dietzfelbinger, 1996) of the 32 bit
+    # integer x formed by the first four bytes of the md5 digest
+    # h(x) = ((a*x + b) mod 2**64) >> (64 - q) for random 64 bit a, b
+    # (for q=64, two independent 32 bit hashes are concatenated)
+    sizes = SimpleTabulation.sizes
+    int_types = SimpleTabulation.int_types
+    cache_factory = functools.partial(BoundedCache, maxsize=2**14)
+    digests = digest.shared
+    def __init__(self, q=64, seed=None):
+        rng = np.random.RandomState() if seed is None else random_stream(seed)
+        self._init(q, self._random_params(q, rng))
+        self._cache = self.cache_factory()
+        instrument.register_cache('MultiplyShift', self._cache)
+
+    def _init(self, q, params):
+        if not q in self.sizes:
+            raise ValueError ('Invalid parameter value for q')
+        self.q = q
+        self.int_type = self.int_types[q]
+        # (parts, 2) array of multipliers a and increments b
+        self.params = np.asarray(params, dtype=np.uint64)
+        if not self.params.shape == (1 if q <= 32 else 2, 2):
+            raise ValueError('Key material does not match parameters')
+        self._shift = np.uint64(64 - min(q, 32))
+
+    @staticmethod
+    def _random_params(q, rng):
+        return rng.randint(0, 2**64, size=(1 if q <= 32 else 2, 2), dtype=np.uint64)
+
+    @classmethod
+    def from_seed(cls, q, seed, *path):
+        return cls.from_key(q, {'params': cls._random_params(q, random_stream(seed, *path))})
+
+    @classmethod
+    def from_key(cls, q, arrays):
+        obj = cls.__new__(cls)
+        obj._init(q, arrays['params'])
+        obj._cache = obj.cache_factory()
+        instrument.register_cache('MultiplyShift', obj._cache)
+        return obj
+
+    def key_arrays(self):
+        return {'params': self.params}
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def hash(self, s):
+        h = self._cache.get(s)
+        if h is None:
+            h = self._hash_key(self.digests.key_of(s, 32))
+            self._cache[s] = h
+        return h
+
+    def hash_id(self, i):
+        # returns the hash of the token with id i
+        # in the digest table
+        return self._hash_key(self.digests.key(i, 32))
+
+    def _hash_key(self, key):
+        # returns the hash of the 32 bit intermediate key bytes key
+        x = key[0] | key[1] << 8 | key[2] << 16 | key[3] << 24
+        h = 0
+        for a, b in self.params.tolist():
+            h = (h << 32) | ((a*x + b) % 2**64) >> int(self._shift)
+        return h
+
+    def hash_many(self, strings):
+        return self.hash_ids(self.digests.ids(strings))
+
+    def hash_ids(self, ids):
+        # returns an array of the hashes for an
+        # array of token ids in the digest table
+        keys = self.digests.key_bytes(ids, 32).astype(np.uint64)
+        with instrument.timed('tabulate', len(keys)):
+            x = (keys[:,0] | keys[:,1] << np.uint64(8) |
+                 keys[:,2] << np.uint64(16) | keys[:,3] << np.uint64(24))
+            h = np.zeros(len(x), dtype=np.uint64)
+            for a, b in self.params:
+                h = (h << np.uint64(32)) | ((a*x + b) >> self._shift)
+            return h.astype(self.int_type)
+
+
+families = dict((klass.__name__, klass) for klass in
+                [SimpleTabulation, KeyedTabulation, TwistedTabulation, MultiplyShift,
+                 ExactTabulation])
+
+def get_family(klass):
+    # returns the hash family class klass (or named klass)
+    if isinstance(klass, basestring):
+        try:
+            return families[klass]
+        except KeyError:
+            raise ValueError('Unknown hash family %s' % klass)
+    return klass
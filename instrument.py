@@ -0,0 +1,211 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+import itertools
+import logging
+import threading
+import time
+import weakref
+
+from cache import NullCache
+
+"""
+Opt-in instrumentation of the hashing and comparison stages.
+
+When enabled (see enable), each stage records the number of calls,
+the number of items processed and the elapsed time:
+
+    tokenize    records tokenized (pipeline.tokenize_many)
+    digest      tokens digested (digest.DigestTable.ids)
+    tabulate    whole-array table lookups (hash_many and hash_ids of
+                the hash families, StackedTabulation)
+    min-reduce  minima of token hashes (Minwise and subclasses)
+    bloom-add   items added to Bloom filters (add_many)
+    compare     pairs of signatures compared (similarity, signatures)
+
+Only batch entry points are timed, so that the cost of a disabled
+stage (a test of a module global, timed returning a shared no-op
+context manager) is spread over a batch. The scalar Bloom filter add
+methods and the scalar comparison functions (J_hat, J_hat_from_conc,
+J_hat_from_bf, D_hat_from_bf and J_hat_from_bf_corrected) are counted
+(calls and items, see count) but not timed.
+
+Caches created by hashers (Minwise, SimpleTabulation and k_hashes)
+are registered (weakly) under a label, so that snapshot can report
+their statistics and the bytes they hold.
+"""
+
+stages = ['tokenize', 'digest', 'tabulate', 'min-reduce', 'bloom-add', 'compare']
+
+enabled = False
+_stats = {}
+_caches = weakref.WeakValueDictionary()
+_ids = itertools.count(1)
+_lock = threading.Lock()
+_clock = time.time
+
+logger = logging.getLogger(__name__)
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    # clears the stage statistics
+    with _lock:
+        _stats.clear()
+
+def record(stage, seconds=0, items=1):
+    # adds a call of stage processing items items in seconds
+    with _lock:
+        stats = _stats.get(stage)
+        if stats is None:
+            stats = _stats[stage] = [0, 0, 0.0]
+        stats[0] += 1
+        stats[1] += items
+        stats[2] += seconds
+
+
+class _Timer(object):
+    __slots__ = ('stage', 'items', 'start')
+    def __init__(self, stage, items):
+        self.stage = stage
+        self.items = items
+
+    def __enter__(self):
+        self.start = _clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.stage, _clock() - self.start, self.items)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_null = _NullTimer()
+
+def timed(stage, items=1):
+    # returns a context manager recording the time taken by
+    # a call of stage processing items items (if enabled)
+    if not enabled:
+        return _null
+    return _Timer(stage, items)
+
+def count(stage, items=1):
+    # records a call of stage processing items items without
+    # timing it (if enabled), for scalar functions whose cost
+    # is comparable to that of a timer
+    if enabled:
+        record(stage, 0, items)
+
+def register_cache(kind, cache):
+    # registers the cache of a hasher of the given kind
+    # and returns its label (None for a NullCache)
+    if isinstance(cache, NullCache):
+        return None
+    label = '%s-%d' % (kind, next(_ids))
+    _caches[label] = cache
+    return label
+
+def cache_stats():
+    # returns a dict mapping the labels of live
+    # registered caches to their statistics
+    # (nbytes being estimated for caches not bounded by maxbytes)
+    res = {}
+    for label, cache in _caches.items():
+        stats = res[label] = cache.stats()
+        stats['nbytes'] = cache.estimated_nbytes()
+    return res
+
+def snapshot():
+    # returns a dict of the stage and cache statistics
+    import digest
+    with _lock:
+        stage_stats = dict((stage, {'calls': calls, 'items': items, 'seconds': seconds})
+                           for stage, (calls, items, seconds) in _stats.items())
+    caches = cache_stats()
+    return {'enabled': enabled,
+            'time': time.time(),
+            'stages': stage_stats,
+            'caches': caches,
+            'cache_nbytes': sum(stats['nbytes'] for stats in caches.values()),
+            'digest': {'tokens': len(digest.shared),
+                       'digested': digest.shared.digested,
+                       'nbytes': digest.shared.nbytes()}}
+
+def log_line(snap=None):
+    # returns a one line summary of a snapshot
+    # (by default a new snapshot)
+    if snap is None:
+        snap = snapshot()
+    parts = []
+    for stage in stages + sorted(set(snap['stages']) - set(stages)):
+        stats = snap['stages'].get(stage)
+        if stats is not None:
+            parts.append('%s %d items %.3fs' % (stage, stats['items'], stats['seconds']))
+    hits = sum(stats['hits'] for stats in snap['caches'].values())
+    lookups = hits + sum(stats['misses'] for stats in snap['caches'].values())
+    parts.append('cache hit rate %s, %d bytes' % ('%.3f' % (hits / lookups) if lookups else 'n/a',
+                                                 snap['cache_nbytes']))
+    parts.append('digest %d tokens, %d bytes' % (snap['digest']['tokens'],
+                                                 snap['digest']['nbytes']))
+    return ' | '.join(parts)
+
+
+class Reporter(threading.Thread):
+    # daemon thread logging a summary line every interval seconds
+    # (see start_reporting)
+    def __init__(self, interval, log):
+        super(Reporter, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.log = log
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.log(log_line())
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+def start_reporting(interval=60, log=None):
+    # enables instrumentation and starts logging a summary
+    # line every interval seconds (by default with the
+    # module logger, at INFO level), returning the Reporter
+    # (whose stop method ends the reporting)
+    enable()
+    reporter = Reporter(interval, log or logger.info)
+    reporter.start()
+    return reporter
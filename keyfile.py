@@ -0,0 +1,153 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+import json
+import struct
+from hashlib import sha256
+
+import numpy as np
+
+import pseudo
+import set_like
+
+"""
+Persistence of hasher key material.
+
+A key file holds the tables (and any other arrays) from which a
+Minwise, B_bit, Concatenated, OnePermutation, OP_B_bit or
+OP_Concatenated hash, or a list of k_hashes functions, is
+constructed, together with the parameters and a checksum.
+
+The file starts with an 8 byte magic string and the length of a
+JSON header (as a little-endian 8 byte integer), followed by the
+header and the arrays, each little-endian and 64 byte aligned, so
+that they can be memory mapped. Processes loading the same file
+share the pages and hash identically (as verified by the checksum).
+"""
+
+MAGIC = b'PSEUDOK1'
+ALIGN = 64
+
+classes = ['Minwise', 'B_bit', 'Concatenated',
+           'OnePermutation', 'OP_B_bit', 'OP_Concatenated']
+
+def _describe(obj):
+    # returns the class name, parameters and key
+    # material of a hasher (or list of k_hashes)
+    if isinstance(obj, list):
+        return 'k_hashes', obj[0].params, obj[0].key
+    name = obj.__class__.__name__
+    if not name in classes:
+        raise TypeError('Cannot persist %s instances' % name)
+    return name, obj.params(), obj.key_material()
+
+def _little(arr):
+    arr = np.asarray(arr)
+    return arr.astype(arr.dtype.newbyteorder('<'), copy=False)
+
+def _checksum(name, params, arrays):
+    h = sha256()
+    h.update(json.dumps([name, params], sort_keys=True).encode('utf-8'))
+    for key in sorted(arrays):
+        h.update(key.encode('utf-8'))
+        h.update(np.ascontiguousarray(_little(arrays[key])).tobytes())
+    return h.hexdigest()
+
+def fingerprint(obj):
+    # returns the checksum identifying the hash functions
+    # of a hasher (or list of k_hashes)
+    return _checksum(*_describe(obj))
+
+def derived_key(obj, purpose):
+    # returns a 32 byte secret derived from the key material
+    # of a hasher (or list of k_hashes) for the given purpose
+    # (a string), e.g. to key fingerprints of token sets
+    name, params, arrays = _describe(obj)
+    h = sha256()
+    h.update(purpose.encode('utf-8'))
+    for key in sorted(arrays):
+        h.update(np.ascontiguousarray(_little(arrays[key])).tobytes())
+    return h.digest()
+
+def save(obj, path):
+    # saves the key material for obj to path
+    name, params, arrays = _describe(obj)
+    layout = []
+    offset = 0
+    for key in sorted(arrays):
+        arr = _little(arrays[key])
+        layout.append({'name': key, 'dtype': arr.dtype.str,
+                       'shape': list(arr.shape), 'offset': offset})
+        offset += -(-arr.nbytes // ALIGN) * ALIGN
+    header = json.dumps({'class': name, 'params': params, 'arrays': layout,
+                         'checksum': _checksum(name, params, arrays)}).encode('utf-8')
+    start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+    header += b' ' * (start - len(MAGIC) - 8 - len(header))
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for item in layout:
+            f.seek(start + item['offset'])
+            f.write(np.ascontiguousarray(_little(arrays[item['name']])).tobytes())
+        f.truncate(start + offset)
+
+def read_header(path):
+    # returns the header dict of a key file and
+    # the offset at which the arrays start
+    with open(path, 'rb') as f:
+        if not f.read(len(MAGIC)) == MAGIC:
+            raise ValueError('%s is not a key file' % path)
+        size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(size).decode('utf-8'))
+    return header, len(MAGIC) + 8 + size
+
+def load(path, stacked=False, mmap=True, verify=True):
+    # returns the hasher (or list of k_hashes) saved at path
+    # if stacked is True, then the tables of a hasher using
+    # simple tabulation are stacked (see Minwise)
+    # if mmap is True, then the arrays are memory mapped
+    # (read only) rather than read into memory
+    # if verify is True, then the checksum is verified
+    header, start = read_header(path)
+    arrays = {}
+    for item in header['arrays']:
+        shape = tuple(item['shape'])
+        offset = start + item['offset']
+        if mmap and np.prod(shape):
+            arr = np.memmap(path, dtype=item['dtype'], mode='r', offset=offset, shape=shape)
+        else:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                arr = np.fromfile(f, dtype=item['dtype'], count=int(np.prod(shape))).reshape(shape)
+        arrays[item['name']] = arr
+    name, params = header['class'], header['params']
+    if verify and not _checksum(name, params, arrays) == header['checksum']:
+        raise ValueError('Checksum mismatch for key file %s' % path)
+    params = dict((str(k), v) for k, v in params.items())
+    if name == 'k_hashes':
+        return set_like.k_hashes(key=arrays, **params)
+    if not name in classes:
+        raise ValueError('Unknown class %s in key file' % name)
+    stacked = stacked and not 'klass' in params
+    return getattr(pseudo, name)(stacked=stacked, key=arrays, **params)
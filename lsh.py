@@ -0,0 +1,151 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+from collections import defaultdict
+from itertools import combinations
+
+from pseudo import J_hat, J_hat_from_conc
+
+"""
+Locality sensitive hashing (banding) index for blocking,
+i.e. generating candidate pairs of records for comparison.
+
+Signatures are b-bit hash lists (as returned by B_bit.hash)
+or concatenated 1-bit hashes (C_hash instances). Each signature
+of length m is split into bands of r consecutive hashes (or bits),
+and records sharing all r values in any band are candidates.
+"""
+
+def collision_probability(J, b=1, N=1):
+    # returns the probability that a single b-bit hash
+    # (or bit of a concatenated hash with XOR compression
+    # factor N) is equal for token sets with Jaccard score J
+    c = (1/2)**b
+    return c + (1-c) * J**N
+
+def candidate_probability(J, r, bands, b=1, N=1):
+    # returns the probability that records with Jaccard
+    # score J are candidates for an index with the
+    # given numbers of rows r and bands
+    return 1 - (1 - collision_probability(J, b, N)**r)**bands
+
+def choose_bands(m, threshold, recall=0.95, b=1, N=1):
+    # returns a tuple (r, bands) for signatures of length m
+    # s.t. pairs with Jaccard score threshold become candidates
+    # with probability at least recall, using the largest
+    # number of rows (and hence the fewest candidates)
+    best = (1, m)
+    for r in range(1, m+1):
+        bands = m // r
+        if candidate_probability(threshold, r, bands, b, N) < recall:
+            break
+        best = (r, bands)
+    return best
+
+
+class LSHIndex(object):
+    def __init__(self, m, threshold, recall=0.95, b=1, N=1, r=None, bands=None):
+        # m is the signature length (number of b-bit hashes,
+        # or bits in a concatenated hash)
+        # b is the number of bits per hash (1 for C_hash instances)
+        # and N the XOR compression factor of concatenated hashes
+        # if r (and bands) are None, then they are chosen s.t. pairs
+        # with Jaccard score threshold become candidates
+        # with probability at least recall
+        if r is None:
+            r, bands = choose_bands(m, threshold, recall, b, N)
+        elif bands is None:
+            bands = m // r
+        if not 0 < r * bands <= m:
+            raise ValueError('Invalid numbers of rows and bands')
+        self._m = m
+        self._b = b
+        self._N = N
+        self.threshold = threshold
+        self.r = r
+        self.bands = bands
+        self._tables = [defaultdict(list) for _ in range(bands)]
+        self._keys = []
+        self._signatures = []
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _band_keys(self, signature):
+        r = self.r
+        if isinstance(signature, (int, long)):
+            # the most significant bit corresponds to the first hash
+            mod = 2**r
+            return [(signature >> (self._m - (i+1)*r)) % mod for i in range(self.bands)]
+        return [tuple(signature[i*r:(i+1)*r]) for i in range(self.bands)]
+
+    def add(self, key, signature):
+        # adds a record (identified by key) with
+        # the given signature to the index
+        i = len(self._keys)
+        self._keys.append(key)
+        self._signatures.append(signature)
+        for table, band in zip(self._tables, self._band_keys(signature)):
+            table[band].append(i)
+
+    def add_many(self, keys, signatures):
+        for key, signature in zip(keys, signatures):
+            self.add(key, signature)
+
+    def query(self, signature):
+        # returns a list of the keys of candidate
+        # records for the given signature
+        inds = set()
+        for table, band in zip(self._tables, self._band_keys(signature)):
+            inds.update(table.get(band, ()))
+        return [self._keys[i] for i in sorted(inds)]
+
+    def _candidate_inds(self):
+        pairs = set()
+        for table in self._tables:
+            for inds in table.itervalues():
+                if len(inds) > 1:
+                    pairs.update(combinations(inds, 2))
+        return sorted(pairs)
+
+    def estimate(self, signature1, signature2):
+        # returns the estimated Jaccard score for two signatures
+        if isinstance(signature1, (int, long)):
+            return J_hat_from_conc(signature1, signature2, self._m, self._N)
+        return J_hat(signature1, signature2, self._b)
+
+    def candidate_pairs(self, verify=False):
+        # returns a list of pairs of keys of candidate records
+        # if verify is True, then each pair is returned as a
+        # triple with its estimated Jaccard score and only pairs
+        # with estimates not less than the threshold are returned
+        keys = self._keys
+        if not verify:
+            return [(keys[i], keys[j]) for i, j in self._candidate_inds()]
+        sigs = self._signatures
+        res = []
+        for i, j in self._candidate_inds():
+            est = self.estimate(sigs[i], sigs[j])
+            if est >= self.threshold:
+                res.append((keys[i], keys[j], est))
+        return res
@@ -0,0 +1,171 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+from collections import defaultdict
+from itertools import combinations
+from math import floor
+
+from bitstring import hamdist
+from pseudo import J_hat_from_conc
+
+"""
+Multi-index hashing (Norouzi, Punjani and Fleet, 2012) for
+Hamming distance searches over concatenated hashes.
+
+Each m-bit hash is split into s substrings, each indexed in its own
+hash table. If two hashes are within Hamming distance R, then
+(by the pigeonhole principle) they are within distance R // s on
+at least one substring, so candidates are found by enumerating
+the substrings within that distance of the query's substrings.
+"""
+
+def radius(threshold, m, N=1):
+    # returns the largest Hamming distance between concatenated
+    # hashes of length m (with XOR compression factor N)
+    # for which J_hat_from_conc is not less than threshold
+    # (by inverting the estimator)
+    if threshold <= 0:
+        return m
+    return int(floor(m * (1 - threshold**N) / 2 + 1e-9))
+
+def _masks(width, r):
+    # returns the masks of the given width with r set bits
+    return [sum(1 << i for i in inds) for inds in combinations(range(width), r)]
+
+
+class MIHIndex(object):
+    def __init__(self, m, s=None, N=1, keys=None, hashes=None):
+        # index of concatenated hashes of length m
+        # (and XOR compression factor N) using s substrings
+        # by default substrings are approximately 16 bits long
+        # (ideally around log2 of the number of hashes indexed)
+        if s is None:
+            s = max(1, int(round(m / 16)))
+        if not 0 < s <= m:
+            raise ValueError('Invalid number of substrings')
+        self._m = m
+        self._N = N
+        self.s = s
+        # substring widths and shifts (the first substring
+        # holding the most significant bits)
+        widths = [m // s + (i < m % s) for i in range(s)]
+        shifts = []
+        shift = m
+        for w in widths:
+            shift -= w
+            shifts.append(shift)
+        self._widths = widths
+        self._shifts = shifts
+        self._tables = [defaultdict(list) for _ in range(s)]
+        self._keys = []
+        self._hashes = []
+        # masks by (width, number of set bits), see _masks_of
+        self._masks = {}
+        if hashes is not None:
+            self.add_many(keys, hashes)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _substrings(self, h):
+        return [(h >> shift) % 2**w for shift, w in zip(self._shifts, self._widths)]
+
+    def add(self, key, h):
+        i = len(self._keys)
+        self._keys.append(key)
+        self._hashes.append(h)
+        for table, sub in zip(self._tables, self._substrings(h)):
+            table[sub].append(i)
+
+    def add_many(self, keys, hashes):
+        # bulk insertion (keys defaults to the indices of the hashes)
+        if keys is None:
+            keys = range(len(self._keys), len(self._keys) + len(hashes))
+        for key, h in zip(keys, hashes):
+            self.add(key, h)
+
+    def _masks_of(self, width, r):
+        # returns the masks of the given width with r set bits
+        # (computed once per index, as they do not depend on the query)
+        try:
+            return self._masks[width, r]
+        except KeyError:
+            masks = self._masks[width, r] = _masks(width, r)
+            return masks
+
+    def _search(self, subs, r, seen):
+        # returns the indices of unseen hashes with a substring
+        # at distance exactly r from the corresponding query substring
+        found = []
+        for table, sub, w in zip(self._tables, subs, self._widths):
+            if r > w:
+                continue
+            for mask in self._masks_of(w, r):
+                for i in table.get(sub ^ mask, ()):
+                    if not i in seen:
+                        seen.add(i)
+                        found.append(i)
+        return found
+
+    def _radius_search(self, h, R):
+        subs = self._substrings(h)
+        seen = set()
+        res = []
+        for r in range(R // self.s + 1):
+            for i in self._search(subs, r, seen):
+                d = hamdist(h, self._hashes[i])
+                if d <= R:
+                    res.append((i, d))
+        return res
+
+    def radius_query(self, h, R):
+        # returns a list of (key, distance) tuples for the
+        # indexed hashes within Hamming distance R of h
+        return [(self._keys[i], d) for i, d in self._radius_search(h, R)]
+
+    def threshold_query(self, h, threshold):
+        # returns a list of (key, estimate) tuples for the indexed
+        # hashes for which J_hat_from_conc is not less than threshold
+        m, N = self._m, self._N
+        res = []
+        for i, d in self._radius_search(h, radius(threshold, m, N)):
+            est = J_hat_from_conc(h, self._hashes[i], m, N)
+            if est >= threshold:
+                res.append((self._keys[i], est))
+        return res
+
+    def knn(self, h, k):
+        # returns a list of (key, distance) tuples for the k
+        # nearest indexed hashes (by Hamming distance) to h
+        # in order of increasing distance
+        subs = self._substrings(h)
+        seen = set()
+        found = []
+        for r in range(max(self._widths) + 1):
+            for i in self._search(subs, r, seen):
+                found.append((hamdist(h, self._hashes[i]), i))
+            found.sort()
+            # all hashes within distance s*(r+1) - 1 have now been seen
+            if len(found) >= k and found[k-1][0] < self.s * (r+1):
+                break
+        return [(self._keys[i], d) for d, i in found[:k]]
@@ -0,0 +1,107 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+from itertools import islice
+
+import instrument
+from set_like import ArrayBloomFilter
+from tokenization import iter_n_grams, iter_positional_n_grams
+
+"""
+Streaming tokenize-and-hash pipeline.
+
+Records are read lazily (from a file or any iterable), tokenized into
+(interned) n-gram token sets and hashed a batch at a time, so memory
+use is bounded by the batch size rather than the size of the input.
+
+A hasher is any object with a hash_many method taking a list of token
+sets (e.g. Minwise, B_bit, Concatenated or a BloomHasher).
+"""
+
+def read_records(source):
+    # returns a generator of records (lines with trailing
+    # newlines removed) from source, which is a file name,
+    # a file object or an iterable of strings
+    if isinstance(source, basestring):
+        with open(source) as f:
+            for line in f:
+                yield line.rstrip('\r\n')
+    else:
+        for line in source:
+            yield line.rstrip('\r\n')
+
+def tokens(record, n=2, pad=False, positional=False):
+    # returns a frozenset of the interned n-gram tokens of record
+    # positional tokens are the n-gram followed by its position
+    # (unambiguous, as n-grams have fixed length n)
+    if positional:
+        grams = ('%s%d' % pos_gram for pos_gram in iter_positional_n_grams(record, n, pad))
+    else:
+        grams = iter_n_grams(record, n, pad)
+    if isinstance(record, str):
+        grams = (intern(gram) for gram in grams)
+    return frozenset(grams)
+
+def tokenize_many(records, n=2, pad=False, positional=False):
+    # returns a list of the token sets for a batch of records
+    records = list(records)
+    with instrument.timed('tokenize', len(records)):
+        return [tokens(record, n, pad, positional) for record in records]
+
+def tokenize(records, n=2, pad=False, positional=False):
+    # returns a generator of token sets for the records in records
+    for record in records:
+        yield tokens(record, n, pad, positional)
+
+def batched(iterable, size):
+    # returns a generator of lists of (at most) size items
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            break
+        yield batch
+
+def hash_records(records, hasher, n=2, pad=False, positional=False, batch_size=1024):
+    # returns a generator of (record, hash) tuples for
+    # the records in records (in order), hashing
+    # batch_size records at a time
+    for batch in batched(records, batch_size):
+        token_sets = tokenize_many(batch, n, pad, positional)
+        for record, h in zip(batch, hasher.hash_many(token_sets)):
+            yield record, h
+
+
+class BloomHasher(object):
+    # hasher returning Bloom filters of length m
+    # built using the hash functions in funcs
+    def __init__(self, m, funcs, klass=ArrayBloomFilter):
+        self.m = m
+        self.funcs = funcs
+        self.klass = klass
+
+    def hash(self, tokens):
+        return self.klass(self.m, self.funcs, tokens)
+
+    def hash_many(self, token_sets):
+        return [self.hash(tokens) for tokens in token_sets]
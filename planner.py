@@ -0,0 +1,245 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+import argparse
+import gc
+import random
+import string
+import time
+from math import ceil, exp, log
+
+import digest
+import pipeline
+from pseudo import Concatenated, MSE_J_hat
+from set_like import k_hashes, opt_k
+
+"""
+Choice of hash parameters by accuracy and cost.
+
+Minwise configurations are planned for a target mean squared error of
+the Jaccard estimate at a given Jaccard score (MSE_J_hat for
+concatenated hashes of m bits with XOR compression factor N, and the
+corresponding binomial variance for lists of m b-bit hashes), and
+Bloom filter configurations for a target false positive rate given the
+number of tokens per record.
+
+The cost of each configuration is its size in bytes and its hashing
+time for the given number of records, the time being estimated from a
+calibration run of the actual hashers on this machine (see calibrate),
+which fits a per-record time linear in the number of hash functions.
+"""
+
+def synthetic_names(count, seed=None):
+    # returns a list of count distinct random name-like strings
+    rng = random.Random(seed)
+    names = set()
+    while len(names) < count:
+        names.add(''.join(rng.choice(string.ascii_lowercase)
+                          for _ in range(rng.randint(4, 12))))
+    return sorted(names)
+
+def _fit(sizes, seconds):
+    # returns (base, per_unit) for a straight line through two points
+    (x0, x1), (y0, y1) = sizes, seconds
+    per_unit = max((y1 - y0) / (x1 - x0), 0)
+    return max(y0 - per_unit * x0, 0), per_unit
+
+def _times(hashers, token_sets, repeat):
+    # returns the per-record times (seconds) of hashing token_sets
+    # with each of the hashers, given as (hasher, caches) pairs,
+    # each the best of repeat runs
+    # the hashers are warmed up first (generating their tables),
+    # each run starts from an empty digest table and empty caches,
+    # so that all hashers are timed from the same state, and the
+    # runs of the hashers are interleaved, so that they share any
+    # slow periods of the machine
+    # (garbage collection is disabled while timing, as by timeit)
+    for hasher, caches in hashers:
+        hasher.hash_many(token_sets)
+    best = [None] * len(hashers)
+    gc_enabled = gc.isenabled()
+    try:
+        for _ in range(repeat):
+            for i, (hasher, caches) in enumerate(hashers):
+                digest.shared.clear()
+                for cache in caches:
+                    cache.clear()
+                gc.disable()
+                start = time.time()
+                hasher.hash_many(token_sets)
+                seconds = time.time() - start
+                if gc_enabled:
+                    gc.enable()
+                if best[i] is None or seconds < best[i]:
+                    best[i] = seconds
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return [seconds / len(token_sets) for seconds in best]
+
+def _minwise_hasher(M, seed):
+    hasher = Concatenated(M, seed=seed, stacked=True)
+    return hasher, [hasher.cache]
+
+def _bloom_hasher(k, seed):
+    funcs = k_hashes(k, 1024, seed)
+    return pipeline.BloomHasher(1024, funcs), [funcs[0].cache]
+
+def calibrate(records=None, n=2, pad=True, sizes=(32, 256), ks=(2, 16), sample=2000, seed=0,
+              repeat=5):
+    # returns a dict of cost models from timing the hashers on
+    # the (distinct) records in records (by default synthetic names)
+    # 'minwise' gives (base, per_hash), the per-record time (seconds)
+    # being base + per_hash * (number of hash functions), 'bloom'
+    # gives (base, per_func) for Bloom filters with k hash functions,
+    # and 'tokens' the mean number of tokens per record
+    # each time is the best of repeat runs (see _times)
+    if records is None:
+        records = synthetic_names(sample, seed)
+    token_sets = [pipeline.tokens(record, n, pad) for record in records[:sample]]
+    minwise = _times([_minwise_hasher(M, seed) for M in sizes], token_sets, repeat)
+    bloom = _times([_bloom_hasher(k, seed) for k in ks], token_sets, repeat)
+    return {'minwise': _fit(sizes, minwise),
+            'bloom': _fit(ks, bloom),
+            'tokens': sum(len(tokens) for tokens in token_sets) / len(token_sets)}
+
+def mse(J, m, b=1, N=1):
+    # returns the MSE of the Jaccard estimate for token sets with
+    # Jaccard score J from m b-bit hashes (J_hat) or, for b=1,
+    # from a concatenated hash of m bits with XOR compression
+    # factor N (J_hat_from_conc, approximate for N > 1)
+    if b == 1:
+        return MSE_J_hat(J, m, N)
+    if not N == 1:
+        raise ValueError('XOR compression requires b=1')
+    c = (1/2)**b
+    P = c + (1-c) * J
+    return P * (1-P) / m / (1-c)**2
+
+def _min_m(J, target, b, N, max_m):
+    # returns the smallest m <= max_m s.t. mse(J, m, b, N) <= target
+    # (or None)
+    if mse(J, max_m, b, N) > target:
+        return None
+    lo, hi = 1, max_m
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if mse(J, mid, b, N) <= target:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+def _cheapest(configs, objective):
+    if not configs:
+        raise ValueError('No configuration meets the target')
+    if objective == 'time':
+        return min(configs, key=lambda c: (c['seconds'], c['bytes']))
+    if objective == 'bytes':
+        return min(configs, key=lambda c: (c['bytes'], c['seconds']))
+    raise ValueError('Unknown objective %s' % objective)
+
+def minwise_configs(J, target, records, calibration, bs=(1, 2, 4, 8), Ns=(1, 2, 4, 8), max_m=2**14):
+    # returns a list of dicts describing the configurations (of each
+    # b, and of each N for b=1) with the smallest m s.t. the MSE at
+    # Jaccard score J is at most target, with their costs for the
+    # given number of records
+    base, per_hash = calibration['minwise']
+    res = []
+    for b in bs:
+        for N in (Ns if b == 1 else (1,)):
+            m = _min_m(J, target, b, N, max_m)
+            if m is None:
+                continue
+            # N*m hash functions are compressed to m bits
+            hashes = m * N if b == 1 else m
+            res.append({'kind': 'conc' if b == 1 else 'bbit', 'm': m, 'b': b, 'N': N,
+                        'hashes': hashes, 'mse': mse(J, m, b, N),
+                        'bytes': records * -(-m * b // 8),
+                        'seconds': records * (base + per_hash * hashes)})
+    return res
+
+def plan_minwise(J, target, records, calibration=None, objective='time', **kwargs):
+    # returns the cheapest (by objective, 'time' or 'bytes')
+    # minwise configuration (see minwise_configs)
+    if calibration is None:
+        calibration = calibrate()
+    return _cheapest(minwise_configs(J, target, records, calibration, **kwargs), objective)
+
+def false_positive_rate(m, k, n):
+    # returns the false positive rate of a Bloom filter of
+    # length m with k hash functions holding n items
+    return (1 - exp(-k * n / m))**k
+
+def bloom_configs(fp, records, calibration, tokens=None, max_k=None):
+    # returns a list of dicts describing the configurations (of each
+    # k) with the smallest m s.t. the false positive rate for
+    # records of tokens items (by default the calibrated mean)
+    # is at most fp, with their costs for the given number of records
+    # k ranges up to max_k (by default twice the optimal k for the
+    # smallest filter meeting the target)
+    if tokens is None:
+        tokens = calibration['tokens']
+    base, per_func = calibration['bloom']
+    if max_k is None:
+        # the smallest filter has m = -n*log(fp)/log(2)**2
+        max_k = int(ceil(2 * opt_k(-tokens * log(fp) / log(2)**2, tokens)))
+    res = []
+    for k in range(1, max(max_k, 1) + 1):
+        m = int(ceil(-k * tokens / log(1 - fp**(1/k))))
+        res.append({'kind': 'bloom', 'm': m, 'k': k,
+                    'fp': false_positive_rate(m, k, tokens),
+                    'bytes': records * -(-m // 8),
+                    'seconds': records * (base + per_func * k)})
+    return res
+
+def plan_bloom(fp, records, calibration=None, objective='time', **kwargs):
+    # returns the cheapest (by objective, 'time' or 'bytes')
+    # Bloom filter configuration (see bloom_configs)
+    if calibration is None:
+        calibration = calibrate()
+    return _cheapest(bloom_configs(fp, records, calibration, **kwargs), objective)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Plan hash parameters')
+    parser.add_argument('--records', type=float, required=True)
+    parser.add_argument('--threshold', type=float, help='Jaccard score for target MSE')
+    parser.add_argument('--mse', type=float, help='target MSE at threshold')
+    parser.add_argument('--fp', type=float, help='target Bloom filter false positive rate')
+    parser.add_argument('--tokens', type=float, help='tokens per record (Bloom filters)')
+    parser.add_argument('--objective', choices=['time', 'bytes'], default='time')
+    args = parser.parse_args(argv)
+    calibration = calibrate()
+    plans = []
+    if args.mse is not None:
+        plans.append(plan_minwise(args.threshold, args.mse, args.records,
+                                  calibration, args.objective))
+    if args.fp is not None:
+        plans.append(plan_bloom(args.fp, args.records, calibration, args.objective,
+                                tokens=args.tokens))
+    for plan in plans:
+        print ', '.join('%s=%s' % item for item in sorted(plan.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -22,69 +22,450 @@
 from __future__ import division
 
 from math import log
+from binascii import hexlify
+import copy
+import functools
 
+import numpy as np
+
+import instrument
 from bitstring import hamdist, digits, popcount
-from tabhash import SimpleTabulation
+from cache import BoundedCache
+from families import get_family
+from tabhash import (SimpleTabulation, StackedTabulation, LazyHashers,
+                     index_tokens, new_seed, random_stream)
 from set_like import BloomFilter
 
 
 class Minwise(object):
-    def __init__(self, m, q=64, seed=None, klass=SimpleTabulation):
+    # the minima are per hasher minima over the tokens
+    # (see IncrementalHash)
+    incremental_minima = True
+    # callable returning the cache for token set hashes
+    # (set to cache.NullCache to disable caching)
+    cache_factory = functools.partial(BoundedCache, maxsize=2**14)
+    def __init__(self, m, q=64, seed=None, klass=SimpleTabulation, stacked=False, key=None):
         # m is the length of the list of hashes returned by the hash method
-        # if seed is not None, then its value will
-        # be used to seed the PRNG
+        # the tables of hasher i are generated from the stream
+        # random_stream(seed, 0, i) when the hasher is first used
+        # (if seed is None, then a fresh seed is drawn, see new_seed)
         # numbits denotes length of hash returned by the hash method
+        # klass is the hash family (see families), or its name
+        # if stacked is True, then the hashers' tables are stacked
+        # in a single array (on first use) and all m minima are
+        # computed in one vectorized pass (stacking requires
+        # klass to be SimpleTabulation)
+        # if key is not None, then it is a dict of key material
+        # (as returned by the key_material method) that is used
+        # in place of generating tables (and seed is ignored)
         if not m > 0:
             raise ValueError('Minwise hash must have length > 0')
-        if not seed is None:
-            np.random.seed(seed)
-        self._hashers = [klass(q=q) for _ in range(m)]
-        self._cache = {}
+        self._m = m
+        self._q = q
+        self._klass = klass = get_family(klass)
+        if stacked and not klass is SimpleTabulation:
+            raise ValueError('Stacked tables require SimpleTabulation, not %s' % klass.__name__)
+        if key is None:
+            if seed is None:
+                seed = new_seed()
+            self._init_hashers(m, q, seed, klass, stacked)
+        else:
+            self._load_hashers(m, q, key, stacked)
+        self._cache = self.cache_factory()
+        instrument.register_cache(self.__class__.__name__, self._cache)
+
+    def _init_hashers(self, m, q, seed, klass, stacked):
+        if hasattr(klass, 'from_seed'):
+            self._hashers = LazyHashers(klass, q, seed, m)
+        else:
+            self._hashers = _seeded_hashers(klass, q, seed, m)
+        self._stacked = stacked
+        self._stack = None
+
+    def _load_hashers(self, m, q, key, stacked):
+        if not all(len(arr) == m for arr in key.values()):
+            raise ValueError('Key material does not match parameters')
+        self._hashers = [self._klass.from_key(q, dict((name, arr[i]) for name, arr in key.items()))
+                         for i in range(m)]
+        self._stacked = stacked
+        self._stack = StackedTabulation(key['tables']) if stacked else None
+
+    @property
+    def _engine(self):
+        # the StackedTabulation instance (if stacked is True),
+        # constructed on first use
+        if self._stacked and self._stack is None:
+            self._stack = StackedTabulation.from_hashers(self._hashers)
+        return self._stack
+
+    def _truncated(self, m):
+        # returns a copy using the last m hashers
+        # (constructing no others)
+        if not 0 < m <= self._m:
+            raise ValueError('Cannot truncate to length %d' % m)
+        res = copy.copy(self)
+        res._m = m
+        start = self._m - m
+        if isinstance(self._hashers, LazyHashers):
+            res._hashers = self._hashers.subset(start, self._m)
+        else:
+            res._hashers = self._hashers[start:]
+        if self._stack is not None:
+            res._stack = StackedTabulation(self._stack.tables[start:])
+        res._cache = self.cache_factory()
+        instrument.register_cache(self.__class__.__name__, res._cache)
+        return res
+
+    def key_material(self):
+        # returns a dict of the arrays from which
+        # the hash functions are constructed
+        if self._engine is not None:
+            return {'tables': self._engine.tables}
+        arrays = [h.key_arrays() for h in self.hashers]
+        return dict((name, np.array([a[name] for a in arrays])) for name in arrays[0])
+
+    def params(self):
+        # returns a dict of the constructor arguments
+        # that determine the hash (given its key material)
+        res = {'m': self._m, 'q': self._q}
+        if not self._klass is SimpleTabulation:
+            res['klass'] = self._klass.__name__
+        return res
 
     @property
     def hashers(self):
         return self._hashers
 
+    @property
+    def cache(self):
+        return self._cache
+
     def hash(self, tokens):
         # returns a list of minwise hashes
+        # (a list of b-bit hashes for B_bit, and
+        # a concatenated 1-bit hash for Concatenated)
         # ensure tokens is a frozenset
         if not isinstance(tokens, frozenset):
             tokens = frozenset(tokens)
-        if not tokens in self._cache:
-            self._cache[tokens] = [min(h.hash(s) for s in tokens) for h in self.hashers]
-        return self._cache[tokens]
+        h = self._cache.get(tokens)
+        if h is None:
+            h = self._signatures(self._minima([tokens]))[0]
+            self._cache[tokens] = h
+        return h
+
+    def hash_many(self, token_sets):
+        # returns a list of the hashes (as returned by the
+        # hash method) for each of the token sets in token_sets
+        # uncached token sets are hashed as a single batch
+        token_sets = [tokens if isinstance(tokens, frozenset) else frozenset(tokens)
+                      for tokens in token_sets]
+        hashes = [self._cache.get(tokens) for tokens in token_sets]
+        new = list(set(tokens for tokens, h in zip(token_sets, hashes) if h is None))
+        if new:
+            computed = dict(zip(new, self._signatures(self._minima(new))))
+            for tokens in new:
+                self._cache[tokens] = computed[tokens]
+            hashes = [computed[tokens] if h is None else h
+                      for tokens, h in zip(token_sets, hashes)]
+        return hashes
+
+    def hash_array(self, token_sets):
+        # returns an (n, m) array of the minimum hashes for
+        # the n token sets in token_sets (b-bit hashes for
+        # B_bit and its subclasses), bypassing the cache
+        return self._minima(token_sets)
+
+    def _minima(self, token_sets):
+        # returns an (n, m) array of the minimum hashes
+        # for the n token sets in token_sets
+        if self._engine is not None:
+            return self._engine.min_hash_many(token_sets)
+        if not all(hasattr(h, 'hash_many') for h in self.hashers):
+            return np.array([[min(h.hash(s) for s in tokens) for h in self.hashers]
+                             for tokens in token_sets], dtype=np.uint64)
+        strings, cols, offsets = index_tokens(token_sets)
+        minima = np.empty((len(offsets), len(self.hashers)), dtype=np.uint64)
+        for j, hashes in enumerate(_hash_strings(self.hashers, strings)):
+            with instrument.timed('min-reduce', len(offsets)):
+                minima[:,j] = np.minimum.reduceat(hashes[cols], offsets)
+        return minima
+
+    def _signatures(self, minima):
+        # returns a list of hashes from an (n, m) array of minima
+        return minima.tolist()
+
+    def _token_hashes(self, strings, rows=None):
+        # returns an (m, n) array of the m hashes of each
+        # of the n strings in strings (or, if rows is not None,
+        # a (len(rows), n) array for the hashers with indices
+        # in rows)
+        if self._engine is not None:
+            if rows is None:
+                return self._engine.hash_many(strings)
+            return StackedTabulation(self._engine.tables[rows]).hash_many(strings)
+        hashers = self.hashers if rows is None else [self.hashers[i] for i in rows]
+        if not all(hasattr(h, 'hash_many') for h in hashers):
+            return np.array([[h.hash(s) for s in strings] for h in hashers], dtype=np.uint64)
+        return np.array(list(_hash_strings(hashers, strings)))
+
+    def incremental(self, tokens):
+        # returns an IncrementalHash for tokens, whose hash
+        # can be updated as tokens are added or removed
+        return IncrementalHash(self, tokens)
+
+
+def _seeded_hashers(klass, q, seed, n):
+    # returns n hashers of a family without from_seed, which
+    # draw their tables from the global numpy PRNG, seeded for
+    # the purpose (its state is restored afterwards)
+    state = np.random.get_state()
+    try:
+        np.random.seed(seed)
+        return [klass(q=q) for _ in range(n)]
+    finally:
+        np.random.set_state(state)
+
+def _hash_strings(hashers, strings):
+    # returns a generator of the arrays of the hashes of the
+    # strings in strings by each of the hashers (with a hash_many
+    # method), each token being digested once per digest table
+    ids = {}
+    for h in hashers:
+        digests = getattr(h, 'digests', None)
+        if digests is None or not hasattr(h, 'hash_ids'):
+            yield h.hash_many(strings)
+            continue
+        if not id(digests) in ids:
+            ids[id(digests)] = digests.ids(strings)
+        yield h.hash_ids(ids[id(digests)])
 
 
 class B_bit(Minwise):
-    def __init__(self, b, m, q=64, seed=None):
-        super(B_bit, self).__init__(m, q, seed)
+    def __init__(self, b, m, q=64, seed=None, klass=SimpleTabulation, stacked=False, key=None):
+        super(B_bit, self).__init__(m, q, seed, klass, stacked, key)
+        self._b = b
         self._mod = 2**b
 
-    def hash(self, tokens):
-        # returns a list of b-bit minwise hashes
-        if not isinstance(tokens, frozenset):
-            tokens = frozenset(tokens)
-        if not tokens in self._cache:
-            mod = self._mod
-            self._cache[tokens] = [x % mod for x in super(B_bit, self).hash(tokens)]
-        return self._cache[tokens]
+    def params(self):
+        res = super(B_bit, self).params()
+        res['b'] = self._b
+        return res
+
+    def hash_array(self, token_sets):
+        return super(B_bit, self).hash_array(token_sets) % self._mod
+
+    def _signatures(self, minima):
+        return super(B_bit, self)._signatures(minima % self._mod)
 
 
 class Concatenated(B_bit):
-    def __init__(self, m, q=64, seed=None):
-        super(Concatenated, self).__init__(1, m, q, seed)
+    def __init__(self, m, q=64, seed=None, klass=SimpleTabulation, stacked=False, key=None):
+        super(Concatenated, self).__init__(1, m, q, seed, klass, stacked, key)
 
-    def hash(self, tokens):
-        # returns a concatenated 1-bit hash
-        if not isinstance(tokens, frozenset):
-            tokens = frozenset(tokens)
-        if not tokens in self._cache:
-            h = 0
-            for i, bit in enumerate(reversed(super(Concatenated, self).hash(tokens))):
-                if bit:
-                    h += (1 << i)
-            self._cache[tokens] = C_hash(h, len(self.hashers))
-        return self._cache[tokens]
+    def params(self):
+        res = super(Concatenated, self).params()
+        del res['b']
+        return res
+
+    def compressed(self, m):
+        # returns a Concatenated hash of length m whose hashes are
+        # those of self compressed to m bits (see C_hash.compressed),
+        # using only the last m hash functions of self (so that
+        # the tables of the others need never be generated)
+        return self._truncated(m)
+
+    def _signatures(self, minima):
+        # the first hash gives the most significant bit
+        m = minima.shape[1]
+        pad = -m % 8
+        rows = np.packbits((minima % 2).astype(np.uint8), axis=1)
+        return [C_hash(int(hexlify(row.tobytes()), 16) >> pad, m) for row in rows]
+
+
+class OnePermutation(Minwise):
+    # one permutation minwise hash with densification
+    # (Shrivastava and Li, 2014)
+    # each token is hashed once and the hashes are split into
+    # m bins (by value modulo m), the hash for each bin being
+    # the minimum (hash // m) of the tokens that fall into it
+    # each empty bin borrows the value of the nearest non-empty
+    # bin in a randomly chosen direction (to the left or right),
+    # the value being XORed with a random word specific to the
+    # distance (in place of the constant offset of the original
+    # scheme, so that low-order bits remain uniform)
+    # the cost of a hash is O(|tokens| + m) rather than O(m*|tokens|)
+    # klass must provide a hash_many method, and q should be
+    # large relative to log2(m) (the default q=64 is recommended)
+    def _init_hashers(self, m, q, seed, klass, stacked):
+        if 2**q < m:
+            raise ValueError('Hash size q too small for %d bins' % m)
+        if hasattr(klass, 'from_seed'):
+            self._hashers = [klass.from_seed(q, seed, 0, 0)]
+        else:
+            self._hashers = _seeded_hashers(klass, q, seed, 1)
+        self._stacked = False
+        self._stack = None
+        # directions and offsets from a separate stream
+        rng = random_stream(seed, 1)
+        self._directions = rng.randint(0, 2, size=m).astype(bool)
+        int_type = SimpleTabulation.int_types[q]
+        self._offsets = rng.randint(0, 2**q, size=m, dtype=int_type)
+        self._offsets[0] = 0
+
+    def _load_hashers(self, m, q, key, stacked):
+        arrays = dict((name, arr) for name, arr in key.items()
+                      if not name in ('directions', 'offsets'))
+        if not (all(len(arr) == 1 for arr in arrays.values()) and len(key['directions']) == m):
+            raise ValueError('Key material does not match parameters')
+        self._hashers = [self._klass.from_key(q, dict((name, arr[0]) for name, arr in arrays.items()))]
+        self._stacked = False
+        self._stack = None
+        self._directions = np.asarray(key['directions'], dtype=bool)
+        self._offsets = np.asarray(key['offsets'], dtype=SimpleTabulation.int_types[q])
+
+    def _truncated(self, m):
+        # the bins depend on m
+        raise TypeError('One permutation hashes cannot be truncated')
+
+    def key_material(self):
+        res = dict((name, arr[None]) for name, arr in self._hashers[0].key_arrays().items())
+        res['directions'] = self._directions.astype(np.uint8)
+        res['offsets'] = self._offsets
+        return res
+
+    # the minima are not per hasher minima over the tokens,
+    # so IncrementalHash recomputes them on each update
+    # (which costs O(|tokens| + m))
+    incremental_minima = False
+
+    def _minima(self, token_sets):
+        strings, cols, offsets = index_tokens(token_sets)
+        hashes = self._hashers[0].hash_many(strings)[cols]
+        with instrument.timed('min-reduce', len(offsets)):
+            return self._densified(hashes, offsets)
+
+    def _densified(self, hashes, offsets):
+        # returns the (n, m) array of minima for the token hashes
+        # of n token sets (starting at offsets), densified
+        m = self._m
+        n = len(offsets)
+        rows = np.repeat(np.arange(n), np.diff(offsets + [len(hashes)]))
+        bins = hashes % m
+        minima = np.empty((n, m), dtype=hashes.dtype)
+        minima.fill(np.iinfo(hashes.dtype).max)
+        np.minimum.at(minima, (rows, bins), hashes // m)
+        filled = np.zeros((n, m), dtype=bool)
+        filled[rows,bins] = True
+        # densify, finding the nearest non-empty bin to the
+        # right and left (circularly) of each bin
+        inds = np.arange(2*m)
+        filled2 = np.hstack([filled, filled])
+        right = np.where(filled2, inds, 2*m)
+        right = np.minimum.accumulate(right[:,::-1], axis=1)[:,::-1][:,:m]
+        left = np.where(filled2, inds, -1)
+        left = np.maximum.accumulate(left, axis=1)[:,m:]
+        src = np.where(self._directions, right, left) % m
+        dist = np.where(self._directions, right - inds[:m], inds[m:] - left)
+        return minima[np.arange(n).reshape(-1, 1),src] ^ self._offsets[dist]
+
+
+class OP_B_bit(OnePermutation, B_bit):
+    # b-bit hashes derived from a one permutation hash
+    pass
+
+
+class OP_Concatenated(OnePermutation, Concatenated):
+    # concatenated 1-bit hash derived from a one permutation hash
+    pass
+
+
+class IncrementalHash(object):
+    # hash of a token set that is updated in place as
+    # tokens are added or removed (see Minwise.incremental)
+    # for each hash function the minimum and second minimum
+    # over the tokens are retained, so adding d tokens costs
+    # O(m*d), as does removing them, except for the hash functions
+    # for which a removed token held both the minimum and the second
+    # minimum, or a minimum whose second minimum is unknown (having
+    # already been promoted), whose minima are recomputed from
+    # the remaining tokens
+    def __init__(self, hasher, tokens):
+        self.hasher = hasher
+        self.recomputed = 0 # number of minima recomputed on removal
+        self._reset(frozenset(tokens))
+
+    def _reset(self, tokens):
+        if not tokens:
+            raise ValueError('Cannot hash an empty token set')
+        self.tokens = tokens
+        if not self.hasher.incremental_minima:
+            self.minima = self.hasher._minima([tokens])[0]
+            return
+        self.minima, self._seconds = _two_smallest(self.hasher._token_hashes(list(tokens)))
+        # whether each second minimum is known
+        self._known = np.ones(len(self.minima), dtype=bool)
+
+    def add(self, tokens):
+        # adds the tokens in tokens
+        new = frozenset(tokens) - self.tokens
+        if not new:
+            return
+        if not self.hasher.incremental_minima:
+            self._reset(self.tokens | new)
+            return
+        hashes = self.hasher._token_hashes(list(new))
+        none = np.iinfo(hashes.dtype).max
+        seconds = np.where(self._known, self._seconds, none)
+        # an unknown second minimum is not less than the minimum,
+        # so is superseded if a new token gives a smaller minimum
+        self._known |= hashes.min(axis=1) <= self.minima
+        self.minima, self._seconds = _two_smallest(
+            np.hstack([self.minima[:,None], seconds[:,None], hashes]))
+        self.tokens = self.tokens | new
+
+    def remove(self, tokens):
+        # removes the tokens in tokens
+        old = frozenset(tokens) & self.tokens
+        if not old:
+            return
+        rest = self.tokens - old
+        if not self.hasher.incremental_minima or not rest:
+            self._reset(rest)
+            return
+        hashes = self.hasher._token_hashes(list(old))
+        none = np.iinfo(hashes.dtype).max
+        hit_min = (hashes == self.minima[:,None]).any(axis=1)
+        hit_second = (hashes == self._seconds[:,None]).any(axis=1)
+        promote = hit_min & self._known & ~hit_second & (self._seconds != none)
+        self.minima = np.where(promote, self._seconds, self.minima)
+        self._known &= ~(promote | hit_second)
+        rows = np.flatnonzero(hit_min & ~promote)
+        if len(rows):
+            self.recomputed += len(rows)
+            minima, seconds = _two_smallest(self.hasher._token_hashes(list(rest), rows))
+            self.minima[rows] = minima
+            self._seconds[rows] = seconds
+            self._known[rows] = True
+        self.tokens = rest
+
+    def hash(self):
+        # returns the hash of the current tokens (as
+        # returned by the hasher's hash method), which
+        # is added to the hasher's cache
+        h = self.hasher._signatures(self.minima[None])[0]
+        self.hasher.cache[self.tokens] = h
+        return h
+
+def _two_smallest(hashes):
+    # returns arrays of the minimum and second minimum of each
+    # row of a 2-d array (the second minimum being the maximum
+    # value of the type for single column arrays)
+    if hashes.shape[1] > 1:
+        two = np.partition(hashes, 1, axis=1)
+        return two[:,0].copy(), two[:,1].copy()
+    seconds = np.empty(len(hashes), dtype=hashes.dtype)
+    seconds.fill(np.iinfo(hashes.dtype).max)
+    return hashes[:,0].copy(), seconds
 
 
 class C_hash(long):
@@ -176,8 +557,9 @@ def J_hat(hashes1, hashes2, b):
     # full hash is negligible
     if not len(hashes1) == len(hashes2):
         raise ValueError('Hash lists must have equal length')
+    instrument.count('compare')
     mod = 2**b
-    frac = sum([(a-b) % mod == 0 for (a,b) in zip(hashes1, hashes2)]) / len(hashes1)
+    frac = sum([(x-y) % mod == 0 for (x,y) in zip(hashes1, hashes2)]) / len(hashes1)
     c = (1/2)**b
     return (frac-c)/(1-c)
 
@@ -192,6 +574,7 @@ def J_hat_from_conc(a, b, m, N=1, truncate=True):
     # if truncate is True, then 0 is
     # returned rather than a negative value
     # N is the compression factor
+    instrument.count('compare')
     try:
         res = (1-2*hamdist(a,b)/m)**(1/N)
     except ValueError:
@@ -235,16 +618,19 @@ def J_hat_from_bf(a, b):
     # returns estimated Jaccard
     # similarity measure for
     # a pair of comparable Bloom filters
+    instrument.count('compare')
     return popcount(a&b) / popcount(a|b)
 
 def D_hat_from_bf(a, b):
     # returns estimated Dice coefficient
     # similarity measure for
     # a pair of comparable Bloom filters
+    instrument.count('compare')
     return 2*popcount(a&b)/(popcount(a) + popcount(b))
 
 def J_hat_from_bf_corrected(a, b, m):
     # bias corrected estimator due to Swamidass and Baldi (2007)
+    instrument.count('compare')
     A = -m*log(1-popcount(a)/m)
     B = -m*log(1-popcount(b)/m)
     AB = -m*log(1-popcount(a|b)/m)
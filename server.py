@@ -0,0 +1,520 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+
+from __future__ import division
+
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from collections import deque
+from Queue import Queue, Empty
+from SocketServer import (ThreadingMixIn, TCPServer, UnixStreamServer,
+                          StreamRequestHandler)
+
+import numpy as np
+
+import pipeline
+from bulk import load_hasher, format_hash
+
+"""
+Long-running pseudonymization server for record-at-a-time clients.
+
+Clients connect over TCP or a Unix socket and send one JSON object
+per line,
+
+    {"id": 1, "record": "smith"}
+
+(or "tokens", a list of tokens, rather than "record"), and receive one
+JSON object per line, in request order,
+
+    {"id": 1, "hash": "3fa0..."}
+
+or {"id": 1, "error": "..."}, hashes being formatted as by bulk.
+{"command": "stats"} returns the server metrics.
+
+The key file is loaded once. Requests from all connections are queued
+and hashed by a single dispatcher thread (so hashers and their caches
+are never shared between threads) in micro-batches of at most
+max_batch records, using the batched hash_many paths. The dispatcher
+takes every queued request and waits at most max_wait seconds after
+the first for the batch to fill, so a lone request is delayed by at
+most max_wait and concurrent requests share a batch.
+
+Connections are served by threads (Python 2 has no asyncio). Requests
+on a connection may be pipelined, responses being written by a writer
+thread per connection as they complete.
+
+Usage:
+
+    python server.py serve KEYFILE [--port 8765 | --unix PATH]
+                           [--max-batch 256 --max-wait 0.002]
+    python server.py load [--port 8765 | --unix PATH]
+                          [--connections 8 --requests 10000 --pipeline 1]
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class Pending(object):
+    # a request awaiting its response
+    __slots__ = ('id', 'tokens', 'start', 'response', 'done')
+    def __init__(self, id, tokens=None, response=None):
+        self.id = id
+        self.tokens = tokens
+        self.start = time.time()
+        self.response = response
+        self.done = threading.Event()
+        if response is not None:
+            self.done.set()
+
+    def resolve(self, response):
+        self.response = response
+        self.done.set()
+
+
+def _utf8(s):
+    return s.encode('utf-8') if isinstance(s, unicode) else s
+
+def percentiles(values, qs=(50, 99)):
+    # returns a dict mapping 'p<q>' to the qth percentile of
+    # values for q in qs (None if values is empty)
+    if not len(values):
+        return dict(('p%d' % q, None) for q in qs)
+    res = np.percentile(values, qs)
+    return dict(('p%d' % q, float(x)) for q, x in zip(qs, res))
+
+def _fmt(x, spec='%.2f'):
+    # formats a metric, which is None if there were no values
+    return 'n/a' if x is None else spec % x
+
+
+class Metrics(object):
+    # counts of requests and batches, and the latencies (in
+    # seconds) and batch sizes of the last window of each
+    def __init__(self, window=10000):
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def record_batch(self, latencies, errors=0):
+        with self._lock:
+            self.requests += len(latencies)
+            self.batches += 1
+            self.errors += errors
+            self.latencies.extend(latencies)
+            self.batch_sizes.append(len(latencies))
+
+    def snapshot(self):
+        # returns a dict of the metrics, latencies in milliseconds
+        with self._lock:
+            latencies = np.array(self.latencies) * 1000
+            sizes = np.array(self.batch_sizes)
+            res = {'requests': self.requests, 'batches': self.batches,
+                   'errors': self.errors, 'uptime': time.time() - self.started}
+        res['latency_ms'] = percentiles(latencies)
+        res['latency_ms']['mean'] = float(latencies.mean()) if len(latencies) else None
+        res['batch_size'] = percentiles(sizes)
+        res['batch_size']['mean'] = float(sizes.mean()) if len(sizes) else None
+        res['batch_size']['max'] = int(sizes.max()) if len(sizes) else None
+        return res
+
+    def log_line(self):
+        # returns a one line summary of the metrics
+        snap = self.snapshot()
+        lat, size = snap['latency_ms'], snap['batch_size']
+        return ('%d requests in %d batches (%d errors) | latency p50 %s ms p99 %s ms | '
+                'batch size mean %s p99 %s' % (snap['requests'], snap['batches'], snap['errors'],
+                                               _fmt(lat['p50']), _fmt(lat['p99']),
+                                               _fmt(size['mean']), _fmt(size['p99'])))
+
+
+class Batcher(threading.Thread):
+    # daemon thread hashing queued requests in micro-batches
+    # (see Service)
+    def __init__(self, hasher, max_batch, max_wait, metrics):
+        super(Batcher, self).__init__()
+        self.daemon = True
+        self.hasher = hasher
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.metrics = metrics
+        self.queue = Queue()
+
+    def submit(self, pending):
+        self.queue.put(pending)
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+    def _collect(self, first):
+        # returns a batch starting with first, and whether
+        # the thread has been stopped
+        batch = [first]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                pending = self.queue.get_nowait()
+            except Empty:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self.queue.get(timeout=remaining)
+                except Empty:
+                    break
+            if pending is None:
+                return batch, True
+            batch.append(pending)
+        return batch, False
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            first = self.queue.get()
+            if first is None:
+                break
+            batch, stopped = self._collect(first)
+            self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        # hashes a batch of requests and resolves them
+        # if the batch fails, then each request is hashed alone,
+        # so that only the failing requests get errors
+        try:
+            hashes = [format_hash(h) for h in self.hasher.hash_many([p.tokens for p in batch])]
+        except Exception:
+            logger.exception('Failed to hash batch of %d records', len(batch))
+            responses = [self._hash_one(p) for p in batch]
+        else:
+            responses = [{'id': p.id, 'hash': h} for p, h in zip(batch, hashes)]
+        # (metrics are recorded first, so that they cover the
+        # batch by the time its responses are seen)
+        now = time.time()
+        errors = sum(1 for response in responses if 'error' in response)
+        self.metrics.record_batch([now - p.start for p in batch], errors)
+        for p, response in zip(batch, responses):
+            p.resolve(response)
+
+    def _hash_one(self, pending):
+        # returns the response for a request hashed alone
+        try:
+            h, = self.hasher.hash_many([pending.tokens])
+            return {'id': pending.id, 'hash': format_hash(h)}
+        except Exception as e:
+            return {'id': pending.id, 'error': 'hashing failed: %s' % e}
+
+
+class Service(object):
+    # hashes requests (dicts, as decoded from the protocol)
+    # in micro-batches of at most max_batch records, waiting
+    # at most max_wait seconds for a batch to fill
+    # records are tokenized into n-grams as by bulk
+    def __init__(self, hasher, n=2, pad=True, positional=False,
+                 max_batch=256, max_wait=0.002):
+        if not max_batch > 0:
+            raise ValueError('max_batch must be > 0')
+        self.hasher = hasher
+        self.options = (n, pad, positional)
+        self.metrics = Metrics()
+        self.batcher = Batcher(hasher, max_batch, max_wait, self.metrics)
+        self.batcher.start()
+
+    @classmethod
+    def from_key(cls, key_path, *args, **kwargs):
+        # returns a Service hashing with the key material in key_path
+        return cls(load_hasher(key_path), *args, **kwargs)
+
+    def submit(self, request):
+        # returns a Pending for request
+        rid = request.get('id')
+        if request.get('command') == 'stats':
+            return Pending(rid, response={'id': rid, 'stats': self.metrics.snapshot()})
+        # records and tokens are hashed as UTF-8 strings (as by bulk)
+        if 'tokens' in request:
+            tokens = request['tokens']
+            if not (isinstance(tokens, list) and
+                    all(isinstance(t, basestring) for t in tokens)):
+                return Pending(rid, response={'id': rid, 'error': 'tokens must be a list of strings'})
+            tokens = frozenset(_utf8(t) for t in tokens)
+        elif 'record' in request:
+            record = request['record']
+            if not isinstance(record, basestring):
+                return Pending(rid, response={'id': rid, 'error': 'record must be a string'})
+            tokens = pipeline.tokens(_utf8(record), *self.options)
+        else:
+            return Pending(rid, response={'id': rid, 'error': 'no record or tokens'})
+        if not tokens:
+            return Pending(rid, response={'id': rid, 'error': 'empty token set'})
+        pending = Pending(rid, tokens)
+        self.batcher.submit(pending)
+        return pending
+
+    def submit_line(self, line):
+        # returns a Pending for a line of the protocol
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('request is not an object')
+        except ValueError as e:
+            return Pending(None, response={'id': None, 'error': 'bad request: %s' % e})
+        return self.submit(request)
+
+    def hash(self, record):
+        # returns the formatted hash of record (blocking)
+        pending = self.submit({'record': record})
+        pending.done.wait()
+        if 'error' in pending.response:
+            raise ValueError(pending.response['error'])
+        return pending.response['hash']
+
+    def close(self):
+        self.batcher.stop()
+
+
+class _Handler(StreamRequestHandler):
+    # reads requests from a connection, writing the
+    # responses (in order) from a writer thread
+    def setup(self):
+        StreamRequestHandler.setup(self)
+        if self.connection.family != socket.AF_UNIX:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        service = self.server.service
+        responses = Queue()
+        writer = threading.Thread(target=self._write, args=(responses,))
+        writer.daemon = True
+        writer.start()
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                if line.strip():
+                    responses.put(service.submit_line(line))
+        except socket.error:
+            pass
+        finally:
+            responses.put(None)
+            writer.join()
+
+    def _write(self, responses):
+        while True:
+            pending = responses.get()
+            if pending is None:
+                break
+            pending.done.wait()
+            try:
+                self.wfile.write(json.dumps(pending.response) + '\n')
+                if responses.empty():
+                    self.wfile.flush()
+            except socket.error:
+                # the client has gone, so the remaining
+                # responses are discarded
+                while responses.get() is not None:
+                    pass
+                break
+
+
+class _TCPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, address):
+    # returns a threaded socket server for service listening at
+    # address, a (host, port) tuple or the path of a Unix socket
+    if isinstance(address, tuple):
+        server = _TCPServer(address, _Handler)
+    else:
+        if os.path.exists(address):
+            os.unlink(address)
+        server = _UnixServer(address, _Handler)
+    server.service = service
+    return server
+
+def serve(key_path, address, n=2, pad=True, positional=False,
+          max_batch=256, max_wait=0.002, report=None, log=None):
+    # serves the key material in key_path at address until
+    # interrupted, logging a summary of the metrics every
+    # report seconds (if not None)
+    service = Service.from_key(key_path, n, pad, positional, max_batch, max_wait)
+    server = make_server(service, address)
+    log = log or logger.info
+    stopped = threading.Event()
+    if report:
+        def reporter():
+            while not stopped.wait(report):
+                log(service.metrics.log_line())
+        thread = threading.Thread(target=reporter)
+        thread.daemon = True
+        thread.start()
+    log('serving %s at %s' % (key_path, address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopped.set()
+        server.server_close()
+        service.close()
+        if not isinstance(address, tuple) and os.path.exists(address):
+            os.unlink(address)
+        log(service.metrics.log_line())
+
+def connect(address):
+    # returns a socket connected to a server at address
+    if isinstance(address, tuple):
+        sock = socket.create_connection(address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    return sock
+
+def _load_connection(address, records, window, latencies, errors):
+    # sends records over a connection, with at most window
+    # requests in flight, recording the latency of each
+    sock = connect(address)
+    rfile = sock.makefile('rb')
+    wfile = sock.makefile('wb')
+    sent = {}
+    try:
+        for i, record in enumerate(records):
+            if len(sent) >= window:
+                _receive(rfile, sent, latencies, errors)
+            sent[i] = time.time()
+            wfile.write(json.dumps({'id': i, 'record': record}) + '\n')
+            if len(sent) >= window or i == len(records) - 1:
+                wfile.flush()
+        while sent:
+            _receive(rfile, sent, latencies, errors)
+    finally:
+        sock.close()
+
+def _receive(rfile, sent, latencies, errors):
+    response = json.loads(rfile.readline())
+    latencies.append(time.time() - sent.pop(response['id']))
+    if 'error' in response:
+        errors.append(response['error'])
+
+def stats(address):
+    # returns the metrics of the server at address
+    sock = connect(address)
+    try:
+        sock.sendall(json.dumps({'command': 'stats'}) + '\n')
+        return json.loads(sock.makefile('rb').readline())['stats']
+    finally:
+        sock.close()
+
+def load(address, connections=8, requests=10000, window=1, seed=0):
+    # generates load from connections concurrent connections,
+    # each sending its share of requests synthetic records (see
+    # bench) with at most window requests in flight, and returns
+    # a dict of the client side throughput and latencies
+    # (in milliseconds) and the server metrics
+    from bench import synthetic_records
+    records = synthetic_records(requests, seed)
+    latencies = []
+    errors = []
+    threads = [threading.Thread(target=_load_connection,
+                                args=(address, records[i::connections], window,
+                                      latencies, errors))
+               for i in range(connections)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+    latency_ms = percentiles(np.array(latencies) * 1000)
+    return {'requests': len(latencies), 'errors': len(errors), 'seconds': seconds,
+            'requests_per_sec': len(latencies) / seconds if seconds else float('inf'),
+            'latency_ms': latency_ms, 'server': stats(address)}
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt
+
+def _address(args):
+    if args.unix:
+        return args.unix
+    return (args.host, args.port)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pseudonymization server')
+    sub = parser.add_subparsers(dest='command')
+    srv = sub.add_parser('serve', help='serve a key file')
+    srv.add_argument('key')
+    gen = sub.add_parser('load', help='generate load against a server')
+    gen.add_argument('--connections', type=int, default=8)
+    gen.add_argument('--requests', type=int, default=10000)
+    gen.add_argument('--pipeline', type=int, default=1,
+                     help='maximum requests in flight per connection')
+    gen.add_argument('--seed', type=int, default=0)
+    for p in [srv, gen]:
+        p.add_argument('--host', default='127.0.0.1')
+        p.add_argument('--port', type=int, default=8765)
+        p.add_argument('--unix', help='Unix socket path (rather than TCP)')
+    srv.add_argument('-n', type=int, default=2)
+    srv.add_argument('--no-pad', dest='pad', action='store_false')
+    srv.add_argument('--positional', action='store_true')
+    srv.add_argument('--max-batch', type=int, default=256)
+    srv.add_argument('--max-wait', type=float, default=0.002,
+                     help='maximum seconds to wait for a batch to fill')
+    srv.add_argument('--report', type=float, help='log metrics every REPORT seconds')
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+        # stops serving (as on an interrupt) when terminated
+        signal.signal(signal.SIGTERM, _terminate)
+        serve(args.key, _address(args), args.n, args.pad, args.positional,
+              args.max_batch, args.max_wait, args.report)
+        return
+    res = load(_address(args), args.connections, args.requests, args.pipeline, args.seed)
+    server = res['server']
+    sys.stderr.write('%(requests)d requests (%(errors)d errors) in %(seconds).2f s '
+                     '(%(requests_per_sec).0f requests/s)\n' % res)
+    sys.stderr.write('client latency p50 %s ms p99 %s ms\n'
+                     % (_fmt(res['latency_ms']['p50']), _fmt(res['latency_ms']['p99'])))
+    sys.stderr.write('server latency p50 %s ms p99 %s ms, batch size mean %s p99 %s\n'
+                     % (_fmt(server['latency_ms']['p50']), _fmt(server['latency_ms']['p99']),
+                        _fmt(server['batch_size']['mean'], '%.1f'),
+                        _fmt(server['batch_size']['p99'], '%.0f')))
+
+
+if __name__ == '__main__':
+    main()
@@ -22,31 +22,89 @@
 from __future__ import division
 
 from math import log
+from binascii import hexlify, unhexlify
 import functools
 
+import numpy as np
+
+import instrument
 from bitstring import digits, popcount
-from tabhash import SimpleTabulation
+from cache import BoundedCache
+from families import get_family
+from tabhash import SimpleTabulation, new_seed
 
 
-def k_hashes(k, m, seed=None):
+def k_hashes(k, m, seed=None, cache_factory=functools.partial(BoundedCache, maxsize=2**16), key=None,
+             klass=SimpleTabulation):
     # returns a list of k hash functions
     # suitable for a Bloom filter of length m
-    # the PRNG used to generate hash functions can be seeded
-    cache = {}
+    # the tables of the two underlying tabulation hashes are
+    # generated from the streams random_stream(seed, 2, i) for
+    # i = 0, 1 (if seed is None, then a fresh seed is drawn, see new_seed)
+    # the hash functions share a cache (returned by cache_factory)
+    # which is available as their cache attribute
+    # if key is not None, then it is a dict of key material
+    # (the key attribute of the functions returned by an earlier
+    # call) used in place of generating tables
+    # klass is the hash family (see families), or its name
+    # the functions' params attribute holds k and m (and klass,
+    # unless SimpleTabulation), and their hashers attribute the
+    # two underlying hashes
+    klass = get_family(klass)
+    cache = cache_factory()
+    instrument.register_cache('k_hashes', cache)
     # generate required size for hashes
-    for q in SimpleTabulation.sizes:
+    for q in klass.sizes:
         if 2**q >= m:
             break
     else:
         raise ValueError('m is too large (> 2**%d)' % q)
-    hash1 = SimpleTabulation(q, seed)
-    hash2 = SimpleTabulation(q)
+    if key is None:
+        if seed is None:
+            seed = new_seed()
+        hash1 = klass.from_seed(q, seed, 2, 0)
+        hash2 = klass.from_seed(q, seed, 2, 1)
+    else:
+        if not all(len(arr) == 2 for arr in key.values()):
+            raise ValueError('Key material does not match parameters')
+        hash1, hash2 = [klass.from_key(q, dict((name, arr[i]) for name, arr in key.items()))
+                        for i in range(2)]
     def f(item, i):
         key = (item, i)
-        if not key in cache:
-            cache[key] = hash1.hash(item) + i * hash2.hash(item)
-        return cache[key]
-    return [functools.partial(f, i=i) for i in range(k)]
+        h = cache.get(key)
+        if h is None:
+            h = hash1.hash(item) + i * hash2.hash(item)
+            cache[key] = h
+        return h
+    funcs = [functools.partial(f, i=i) for i in range(k)]
+    arrays = [hash1.key_arrays(), hash2.key_arrays()]
+    key = dict((name, np.array([a[name] for a in arrays])) for name in arrays[0])
+    params = {'k': k, 'm': m}
+    if not klass is SimpleTabulation:
+        params['klass'] = klass.__name__
+    for func in funcs:
+        func.cache = cache
+        func.key = key
+        func.params = params
+        func.hashers = (hash1, hash2)
+    return funcs
+
+
+def _to_array(bits, m):
+    # returns a uint8 array holding the m bits of a Python long
+    # (bit i in bit i % 8 of byte i // 8)
+    nbytes = -(-m // 8)
+    arr = np.frombuffer(unhexlify('%0*x' % (nbytes*2, bits)), dtype=np.uint8)
+    return arr[::-1].copy()
+
+def _to_long(arr):
+    # inverse of _to_array
+    return int(hexlify(arr[::-1].tobytes()), 16)
+
+def _set_indices(arr, indices):
+    # sets the bits at indices in a uint8 array
+    indices = np.asarray(indices, dtype=np.int64)
+    np.bitwise_or.at(arr, indices >> 3, (1 << (indices & 7)).astype(np.uint8))
 
 
 class BloomFilter(object):
@@ -71,10 +129,36 @@ class BloomFilter(object):
         return hex(self.bits)
 
     def add(self, item):
+        instrument.count('bloom-add')
         for func in self.funcs:
             index = func(item) % self._m
             self.bits = self.bits | (1 << index)
 
+    def add_many(self, items):
+        # adds the items in items, hashed as a batch
+        items = list(items)
+        with instrument.timed('bloom-add', len(items)):
+            arr = np.zeros(-(-self._m // 8), dtype=np.uint8)
+            _set_indices(arr, self._indices(items))
+            self.bits = self.bits | _to_long(arr)
+
+    def _indices(self, items):
+        # returns an array of the len(funcs) * len(items) bit indices
+        # for the items (computed with whole-array operations if
+        # the functions were returned by a single call to k_hashes)
+        items = list(items)
+        m = self._m
+        hashers = set(getattr(func, 'hashers', None) for func in self.funcs)
+        if len(hashers) != 1 or None in hashers:
+            return np.array([func(item) % m for item in items for func in self.funcs], dtype=np.int64)
+        hash1, hash2 = hashers.pop()
+        mod = np.uint64(m)
+        h1 = hash1.hash_many(items).astype(np.uint64) % mod
+        h2 = hash2.hash_many(items).astype(np.uint64) % mod
+        i = np.array([func.keywords['i'] for func in self.funcs], dtype=np.uint64)
+        # (h1 + i*h2) % m, without overflow
+        return ((h1[:,None] + (i[None,:] * h2[:,None]) % mod) % mod).ravel().astype(np.int64)
+
     def __contains__(self, item):
         # can generate false positives
         for func in self.funcs:
@@ -130,6 +214,148 @@ class BloomFilter(object):
         return self._m
 
 
+class ArrayBloomFilter(BloomFilter):
+    # Bloom filter storing its bits in a numpy uint8 array
+    # (bit i in bit i % 8 of byte i // 8) rather than a Python long
+    # the bits attribute converts to and from the long representation
+    def __init__(self, m, funcs, items=None):
+        super(ArrayBloomFilter, self).__init__(m, funcs)
+        if items is not None:
+            self.add_many(items)
+
+    @property
+    def bits(self):
+        return _to_long(self.array)
+
+    @bits.setter
+    def bits(self, value):
+        self.array = _to_array(value, self._m)
+
+    @classmethod
+    def from_filter(cls, bf):
+        # returns an instance with the same bits as Bloom filter bf
+        res = cls(bf.m, bf.funcs)
+        res.bits = bf.bits
+        return res
+
+    def add(self, item):
+        instrument.count('bloom-add')
+        _set_indices(self.array, [func(item) % self._m for func in self.funcs])
+
+    def add_many(self, items):
+        items = list(items)
+        with instrument.timed('bloom-add', len(items)):
+            _set_indices(self.array, self._indices(items))
+
+    def __contains__(self, item):
+        for func in self.funcs:
+            index = func(item) % self._m
+            if not (self.array[index >> 3] >> (index & 7)) & 1:
+                return False
+        return True
+
+    def union(self, other):
+        if isinstance(other, ArrayBloomFilter):
+            res = self.__class__(self._m, self.funcs)
+            res.array = self.array | other.array
+            return res
+        return super(ArrayBloomFilter, self).union(other)
+
+    def intersection(self, other):
+        if isinstance(other, ArrayBloomFilter):
+            res = self.__class__(self._m, self.funcs)
+            res.array = self.array & other.array
+            return res
+        return super(ArrayBloomFilter, self).intersection(other)
+
+    def count(self):
+        # returns the number of set bits
+        return int(np.unpackbits(self.array).sum())
+
+    def estimated_size(self):
+        return -self._m * log(1-self.count()/self._m) / len(self.funcs)
+
+
+class CountingBloomFilter(ArrayBloomFilter):
+    # Bloom filter holding a count per bit (in a numpy array
+    # of type dtype), so that items can be removed
+    # the bit array (and bits) are derived from the non-zero counts
+    # removing an item that was not added can introduce
+    # false negatives
+    def __init__(self, m, funcs, items=None, dtype=np.uint16):
+        self.dtype = dtype
+        super(CountingBloomFilter, self).__init__(m, funcs, items)
+
+    @property
+    def array(self):
+        bits = np.zeros(-(-self._m // 8) * 8, dtype=np.uint8)
+        bits[:self._m] = self.counts > 0
+        return np.packbits(bits.reshape(-1, 8)[:,::-1], axis=1).ravel()
+
+    @array.setter
+    def array(self, value):
+        bits = np.unpackbits(np.asarray(value, dtype=np.uint8).reshape(-1, 1), axis=1)
+        self.counts = bits[:,::-1].ravel()[:self._m].astype(self.dtype)
+
+    def _update(self, indices, sign):
+        # adds sign to the counts at indices (which can repeat)
+        # in place, touching only those counts, which are checked
+        # before any is changed
+        cells, n = np.unique(np.asarray(indices, dtype=np.int64), return_counts=True)
+        counts = self.counts[cells].astype(np.int64) + sign * n
+        self._check_counts(counts)
+        self.counts[cells] = counts
+
+    def _check_counts(self, counts):
+        if len(counts) and counts.min() < 0:
+            raise ValueError('Cannot remove items not in the filter')
+        if len(counts) and counts.max() > np.iinfo(self.dtype).max:
+            raise OverflowError('Count exceeds maximum for %s' % np.dtype(self.dtype).name)
+
+    def _set_counts(self, counts):
+        self._check_counts(counts)
+        self.counts = counts.astype(self.dtype)
+
+    def add(self, item):
+        instrument.count('bloom-add')
+        self._update([func(item) % self._m for func in self.funcs], 1)
+
+    def add_many(self, items):
+        items = list(items)
+        with instrument.timed('bloom-add', len(items)):
+            self._update(self._indices(items), 1)
+
+    def remove(self, item):
+        # removes item (which must have been added)
+        self._update([func(item) % self._m for func in self.funcs], -1)
+
+    def remove_many(self, items):
+        # removes the items in items, hashed as a batch
+        self._update(self._indices(items), -1)
+
+    def __contains__(self, item):
+        return all(self.counts[func(item) % self._m] for func in self.funcs)
+
+    def union(self, other):
+        # the counts of counting filters are summed
+        if isinstance(other, CountingBloomFilter):
+            res = self.__class__(self._m, self.funcs, dtype=self.dtype)
+            res._set_counts(self.counts.astype(np.int64) + other.counts)
+            return res
+        return super(CountingBloomFilter, self).union(other)
+
+    def intersection(self, other):
+        # the minimum counts of counting filters are retained
+        if isinstance(other, CountingBloomFilter):
+            res = self.__class__(self._m, self.funcs, dtype=self.dtype)
+            res.counts = np.minimum(self.counts, other.counts).astype(self.dtype)
+            return res
+        return super(CountingBloomFilter, self).intersection(other)
+
+    def count(self):
+        return int(np.count_nonzero(self.counts))
+
+
 def get_k(m, n, p=0.5):
     # returns an estimate of the number of hash functions k s.t.
     # the expected proportion of set bits is p, given m bits in
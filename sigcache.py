@@ -0,0 +1,216 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+import hmac
+import sqlite3
+import struct
+from binascii import hexlify, unhexlify
+from hashlib import sha256
+
+import numpy as np
+
+import keyfile
+from pseudo import C_hash
+from set_like import BloomFilter
+
+"""
+Persistent (sqlite) cache of signatures.
+
+Signatures (hash lists, concatenated hashes or Bloom filters) are
+stored keyed by the fingerprint of the hasher's key material
+(keyfile.fingerprint) and a keyed fingerprint of the token set: an
+HMAC-SHA256 of the sorted tokens, keyed by a secret derived from the
+key material (keyfile.derived_key). So signatures computed with other
+keys are never returned, and neither tokens nor anything from which
+they could be recovered without the key are stored.
+
+Lookups and inserts are done in bulk, so a re-run over a mostly
+unchanged population costs little more than reading the database.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS signatures (
+    key TEXT NOT NULL,
+    fingerprint BLOB NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (key, fingerprint)
+)
+"""
+
+# maximum number of parameters in a lookup query
+# (below the sqlite default limit of 999)
+CHUNK = 500
+
+def _key_obj(hasher):
+    # returns the object whose key material identifies
+    # hasher (the functions of a BloomHasher)
+    return getattr(hasher, 'funcs', hasher)
+
+def encode(h):
+    # returns the bytes representing a signature
+    if isinstance(h, C_hash):
+        return b'c' + struct.pack('<II', h.m, h.N) + unhexlify('%0*x' % (-(-h.m // 8) * 2, h))
+    if isinstance(h, BloomFilter):
+        return b'b' + struct.pack('<I', h.m) + unhexlify('%0*x' % (-(-h.m // 8) * 2, h.bits))
+    return b'l' + np.asarray(h, dtype='<u8').tobytes()
+
+def decode(value, hasher):
+    # returns the signature represented by value (as returned
+    # by encode) for hasher (used to construct Bloom filters)
+    tag, body = value[:1], value[1:]
+    if tag == b'c':
+        m, N = struct.unpack('<II', body[:8])
+        return C_hash(int(hexlify(body[8:]), 16), m, N)
+    if tag == b'b':
+        m, = struct.unpack('<I', body[:4])
+        bf = hasher.klass(m, hasher.funcs)
+        bf.bits = int(hexlify(body[4:]), 16)
+        return bf
+    return np.frombuffer(body, dtype='<u8').tolist()
+
+
+class SignatureCache(object):
+    # persistent cache of the signatures computed by hasher (any
+    # object with a hash_many method and key material that can be
+    # saved with keyfile, or a pipeline.BloomHasher) in the sqlite
+    # database at path
+    # secret keys the token set fingerprints (by default it is
+    # derived from the key material)
+    def __init__(self, path, hasher, secret=None, readonly=False):
+        self.path = path
+        self.hasher = hasher
+        obj = _key_obj(hasher)
+        self.key = keyfile.fingerprint(obj)
+        if secret is None:
+            secret = keyfile.derived_key(obj, 'signature cache')
+        self._secret = secret
+        self.readonly = readonly
+        if readonly:
+            self._conn = sqlite3.connect(path)
+            self._conn.execute('PRAGMA query_only = ON')
+        else:
+            self._conn = sqlite3.connect(path)
+            self._conn.execute('PRAGMA journal_mode = WAL')
+            self._conn.execute(SCHEMA)
+            self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def __len__(self):
+        # returns the number of signatures stored for the key
+        cur = self._conn.execute('SELECT COUNT(*) FROM signatures WHERE key = ?', (self.key,))
+        return cur.fetchone()[0]
+
+    def fingerprint(self, tokens):
+        # returns the keyed fingerprint of a token set
+        mac = hmac.new(self._secret, digestmod=sha256)
+        for s in sorted(set(tokens)):
+            if isinstance(s, unicode):
+                s = s.encode('utf-8')
+            # length prefixed, so that the encoding is unambiguous
+            mac.update(struct.pack('<I', len(s)))
+            mac.update(s)
+        return mac.digest()
+
+    def get_many(self, token_sets, fingerprints=None):
+        # returns a list of the stored signatures for the
+        # token sets in token_sets (None where not stored)
+        if fingerprints is None:
+            fingerprints = [self.fingerprint(tokens) for tokens in token_sets]
+        found = {}
+        distinct = list(set(fingerprints))
+        for i in range(0, len(distinct), CHUNK):
+            chunk = distinct[i:i+CHUNK]
+            cur = self._conn.execute(
+                'SELECT fingerprint, value FROM signatures WHERE key = ? '
+                'AND fingerprint IN (%s)' % ','.join('?' * len(chunk)),
+                [self.key] + [sqlite3.Binary(fp) for fp in chunk])
+            for fp, value in cur:
+                found[bytes(fp)] = decode(bytes(value), self.hasher)
+        res = [found.get(fp) for fp in fingerprints]
+        hits = sum(h is not None for h in res)
+        self.hits += hits
+        self.misses += len(res) - hits
+        return res
+
+    def rows(self, token_sets, hashes, fingerprints=None):
+        # returns a list of (fingerprint, value) tuples for the
+        # token sets and their signatures (as taken by put_rows)
+        if fingerprints is None:
+            fingerprints = [self.fingerprint(tokens) for tokens in token_sets]
+        return [(fp, encode(h)) for fp, h in zip(fingerprints, hashes)]
+
+    def put_rows(self, rows):
+        # stores a list of (fingerprint, value) tuples
+        # (in a single transaction)
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO signatures (key, fingerprint, value) VALUES (?, ?, ?)',
+                [(self.key, sqlite3.Binary(fp), sqlite3.Binary(value)) for fp, value in rows])
+
+    def put_many(self, token_sets, hashes):
+        # stores the signatures for the token sets in token_sets
+        self.put_rows(self.rows(token_sets, hashes))
+
+    def lookup(self, token_sets):
+        # returns a tuple (hashes, rows) where hashes is a list of the
+        # signatures for the token sets in token_sets (those not stored
+        # being computed as a batch) and rows a list of the rows for
+        # the computed signatures, which are not stored (so that
+        # readonly instances can pass them to a writer)
+        token_sets = list(token_sets)
+        fingerprints = [self.fingerprint(tokens) for tokens in token_sets]
+        hashes = self.get_many(token_sets, fingerprints)
+        missing = [i for i, h in enumerate(hashes) if h is None]
+        rows = []
+        if missing:
+            computed = self.hasher.hash_many([token_sets[i] for i in missing])
+            for i, h in zip(missing, computed):
+                hashes[i] = h
+            # each distinct token set is stored once
+            rows = list(dict(self.rows(None, computed, [fingerprints[i] for i in missing])).items())
+        return hashes, rows
+
+    def hash_many(self, token_sets):
+        # returns a list of the signatures for the token sets in
+        # token_sets, computing and storing those not stored
+        hashes, rows = self.lookup(token_sets)
+        if rows:
+            self.put_rows(rows)
+        return hashes
+
+    def hash(self, tokens):
+        return self.hash_many([tokens])[0]
+
+    def stats(self):
+        # returns a dict of cache statistics
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
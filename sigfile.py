@@ -0,0 +1,227 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+import json
+import os
+import struct
+from binascii import hexlify
+
+import numpy as np
+
+from pseudo import C_hash
+from signatures import BbitSignatures, CHashBatch
+from similarity import pack
+
+"""
+Binary files of fixed width signature records.
+
+A signature file starts with an 8 byte magic string and the length
+of a JSON header (as a little-endian 8 byte integer), followed by the
+header (padded to a multiple of 64 bytes) and the records. The header
+gives the kind of signature ('conc', 'bloom' or 'bbit'), the
+parameters m, N and b, and the fingerprint of the key material
+(keyfile.fingerprint) used to generate the signatures.
+
+Each record is an array of little-endian 64 bit words: for concatenated
+hashes and Bloom filters the m bits packed most significant word first
+(as similarity.pack), and for b-bit signatures b bit planes (as
+BbitSignatures). As the number of records is implied by the file size,
+batches can be appended without rewriting the file, and readers
+memory map the records as a (n, ...) numpy array without copying.
+"""
+
+MAGIC = b'PSEUDOS1'
+ALIGN = 64
+
+kinds = ['conc', 'bloom', 'bbit']
+
+def record_shape(kind, m, b=1):
+    # returns the shape of a record (in 64 bit words)
+    words = -(-m // 64)
+    if kind == 'bbit':
+        return (b, words)
+    return (words,)
+
+def create(path, kind, m, N=1, b=1, fingerprint=None):
+    # creates an empty signature file (overwriting any existing file)
+    if not kind in kinds:
+        raise ValueError('Unknown kind of signature %s' % kind)
+    header = json.dumps({'kind': kind, 'm': m, 'N': N, 'b': b,
+                         'fingerprint': fingerprint,
+                         'shape': list(record_shape(kind, m, b))}).encode('utf-8')
+    start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+    header += b' ' * (start - len(MAGIC) - 8 - len(header))
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+
+def read_header(path):
+    # returns the header dict of a signature file and
+    # the offset at which the records start
+    with open(path, 'rb') as f:
+        if not f.read(len(MAGIC)) == MAGIC:
+            raise ValueError('%s is not a signature file' % path)
+        size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(size).decode('utf-8'))
+    return header, len(MAGIC) + 8 + size
+
+def _padding_clear(kind, m, arr):
+    # returns True if the bits of the records in arr beyond
+    # the m bits of a signature are all zero
+    pad = -m % 64
+    if not pad:
+        return True
+    if kind == 'bbit':
+        # planes are packed with np.packbits, bit m onwards
+        # being the tail of each plane
+        planes = np.ascontiguousarray(arr, dtype='<u8').view(np.uint8)
+        tail = planes[...,-(-m // 8):]
+        if m % 8 and (planes[...,m // 8] & np.uint8((1 << (8 - m % 8)) - 1)).any():
+            return False
+        return not tail.any()
+    # the padding is the most significant bits of the first word
+    return not (arr[...,0] >> np.uint64(64 - pad)).any()
+
+def _records(header, data):
+    # returns an (n, ...) array of records for data, which is a
+    # packed array, a BbitSignatures or CHashBatch instance or a sequence of
+    # C_hash / BloomFilter instances / Python longs (or, for
+    # 'bbit', of b-bit hash lists)
+    # signatures must have the length m of the header (for packed
+    # arrays, the bits beyond m must be zero)
+    kind, m = header['kind'], header['m']
+    if isinstance(data, BbitSignatures):
+        if not (kind == 'bbit' and data.m == m and data.b == header['b']):
+            raise ValueError('Signatures do not match file parameters')
+        arr = data.planes
+    elif isinstance(data, CHashBatch):
+        if not (kind == 'conc' and data.m == m and data.N == header['N']):
+            raise ValueError('Signatures do not match file parameters')
+        arr = data.words
+    elif isinstance(data, np.ndarray) and data.dtype == np.uint64:
+        arr = data
+    elif kind == 'bbit':
+        signatures = BbitSignatures(data, header['b'])
+        if len(signatures) and not signatures.m == m:
+            raise ValueError('Signatures do not match file parameters')
+        arr = signatures.planes
+    else:
+        data = list(data)
+        for h in data:
+            if getattr(h, 'm', m) != m or getattr(h, 'N', header['N']) != header['N']:
+                raise ValueError('Signatures do not match file parameters')
+            if getattr(h, 'bits', h) >> m:
+                raise ValueError('Signature has more than %d bits' % m)
+        arr = pack(data, m)
+    if not arr.shape[1:] == tuple(header['shape']):
+        raise ValueError('Records do not match file parameters')
+    if not _padding_clear(kind, m, arr):
+        raise ValueError('Records have bits set beyond length %d' % m)
+    return np.ascontiguousarray(arr, dtype='<u8')
+
+def append(path, data, fingerprint=None):
+    # appends a batch of signatures to the file at path
+    # if fingerprint is not None, then it must match the
+    # fingerprint in the header
+    header, start = read_header(path)
+    if fingerprint is not None and fingerprint != header['fingerprint']:
+        raise ValueError('Key fingerprint does not match %s' % path)
+    arr = _records(header, data)
+    record_bytes = 8 * int(np.prod(header['shape']))
+    with open(path, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell() - start
+        # discard any partially written record
+        f.seek(start + size - size % record_bytes)
+        f.write(arr.tobytes())
+        f.truncate()
+
+def write(path, kind, data, m, N=1, b=1, fingerprint=None):
+    # creates a signature file holding the signatures in data
+    create(path, kind, m, N, b, fingerprint)
+    append(path, data)
+
+
+class SignatureFile(object):
+    # signatures read from a signature file (see load)
+    def __init__(self, header, records):
+        self.header = header
+        self.kind = header['kind']
+        self.m = header['m']
+        self.N = header['N']
+        self.b = header['b']
+        self.fingerprint = header['fingerprint']
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def bits(self):
+        # returns a list of the signatures as Python longs
+        # (for 'conc' and 'bloom' files)
+        if self.kind == 'bbit':
+            raise TypeError('b-bit signatures are not bitstrings')
+        big = self.records.astype('>u8')
+        return [int(hexlify(row.tobytes()), 16) for row in big]
+
+    def c_hashes(self):
+        # returns a list of C_hash instances (for 'conc' files)
+        if not self.kind == 'conc':
+            raise TypeError('Not a concatenated hash file')
+        return [C_hash(h, self.m, self.N) for h in self.bits()]
+
+    def batch(self):
+        # returns a CHashBatch instance viewing
+        # the records (for 'conc' files)
+        if not self.kind == 'conc':
+            raise TypeError('Not a concatenated hash file')
+        return CHashBatch(self.records, self.m, self.N)
+
+    def bbit(self):
+        # returns a BbitSignatures instance viewing
+        # the records (for 'bbit' files)
+        if not self.kind == 'bbit':
+            raise TypeError('Not a b-bit signature file')
+        return BbitSignatures.from_planes(self.records, self.m)
+
+def load(path, mmap=True, fingerprint=None):
+    # returns a SignatureFile for the file at path, whose
+    # records are memory mapped (read only) if mmap is True
+    # if fingerprint is not None, then it must match the
+    # fingerprint in the header
+    header, start = read_header(path)
+    if fingerprint is not None and fingerprint != header['fingerprint']:
+        raise ValueError('Key fingerprint does not match %s' % path)
+    shape = tuple(header['shape'])
+    if not shape == record_shape(header['kind'], header['m'], header['b']):
+        raise ValueError('Record shape does not match m in %s' % path)
+    record_bytes = 8 * int(np.prod(shape))
+    n = (os.path.getsize(path) - start) // record_bytes
+    if mmap and n:
+        records = np.memmap(path, dtype='<u8', mode='r', offset=start, shape=(n,) + shape)
+    else:
+        with open(path, 'rb') as f:
+            f.seek(start)
+            records = np.fromfile(f, dtype='<u8', count=n * record_bytes // 8).reshape((n,) + shape)
+    return SignatureFile(header, records)
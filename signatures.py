@@ -0,0 +1,221 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+from binascii import hexlify
+
+import numpy as np
+
+import instrument
+from bitstring import popcount_array
+from pseudo import C_hash
+from similarity import pack
+
+"""
+Columnar containers for batches of signatures.
+"""
+
+
+class BbitSignatures(object):
+    # container for n b-bit minwise signatures of length m,
+    # stored bit-sliced: an (n, b, words) array of 64 bit words,
+    # plane p holding bit p of each of the m hashes
+    # (so each signature occupies b*m bits, rounded up to words)
+    def __init__(self, values, b):
+        # values is an (n, m) array (or list of lists) of b-bit hashes
+        # (e.g. as returned by B_bit.hash_array or B_bit.hash_many)
+        values = np.asarray(values, dtype=np.uint64)
+        if values.ndim != 2:
+            raise ValueError('values must be two dimensional')
+        self.b = b
+        self.m = values.shape[1]
+        self.planes = self._slice(values)
+
+    def _slice(self, values):
+        n, m = values.shape
+        nbytes = -(-m // 64) * 8
+        planes = np.zeros((n, self.b, nbytes), dtype=np.uint8)
+        for p in range(self.b):
+            bits = ((values >> np.uint64(p)) & np.uint64(1)).astype(np.uint8)
+            packed = np.packbits(bits, axis=1)
+            planes[:,p,:packed.shape[1]] = packed
+        return planes.view(np.uint64)
+
+    @classmethod
+    def from_planes(cls, planes, m):
+        # returns an instance wrapping an existing (n, b, words)
+        # array of bit planes for signatures of length m
+        obj = cls.__new__(cls)
+        obj.planes = planes
+        obj.b = planes.shape[1]
+        obj.m = m
+        return obj
+
+    def __len__(self):
+        return self.planes.shape[0]
+
+    def __getitem__(self, i):
+        # returns signature i as a list of b-bit hashes
+        return self.values(slice(i, i+1))[0].tolist()
+
+    def values(self, rows=slice(None)):
+        # returns the (n, m) array of b-bit hashes (for the given rows)
+        planes = self.planes[rows]
+        res = np.zeros((planes.shape[0], self.m), dtype=np.uint64)
+        for p in range(self.b):
+            plane = np.ascontiguousarray(planes[:,p]).view(np.uint8)
+            bits = np.unpackbits(plane, axis=1)[:,:self.m]
+            res |= bits.astype(np.uint64) << np.uint64(p)
+        return res
+
+    def nbytes(self):
+        return self.planes.nbytes
+
+    def _matches(self, a, b):
+        # returns the matrix of numbers of equal hashes
+        # between the signatures in planes a and b
+        # (padding bits are zero in both, so never differ)
+        with instrument.timed('compare', len(a) * len(b)):
+            diff = a[:,None] ^ b[None,:]
+            neq = np.bitwise_or.reduce(diff, axis=2)
+            return self.m - popcount_array(neq)
+
+    def _estimate(self, matches):
+        c = (1/2)**self.b
+        return (matches / self.m - c) / (1 - c)
+
+    def J_hat_one(self, hashes):
+        # returns an array of the estimated Jaccard scores
+        # (as returned by J_hat) between each signature and
+        # the b-bit signature hashes
+        if not len(hashes) == self.m:
+            raise ValueError('Hash lists must have equal length')
+        other = self._slice(np.asarray([hashes], dtype=np.uint64) % np.uint64(2**self.b))
+        return self._estimate(self._matches(self.planes, other))[:,0]
+
+    def J_hat_many(self, other, block_words=2**16):
+        # returns the (len(self), len(other)) matrix of
+        # estimated Jaccard scores between the signatures
+        # of self and those of other (an instance with the
+        # same b and m), computed a block at a time
+        if not (other.b == self.b and other.m == self.m):
+            raise ValueError('Signatures must have equal b and m')
+        words = self.planes.shape[1] * self.planes.shape[2]
+        rows = max(1, int((block_words / words) ** 0.5))
+        res = np.empty((len(self), len(other)))
+        for i in range(0, len(self), rows):
+            for j in range(0, len(other), rows):
+                matches = self._matches(self.planes[i:i+rows], other.planes[j:j+rows])
+                res[i:i+rows,j:j+rows] = self._estimate(matches)
+        return res
+
+
+class CHashBatch(object):
+    # container for n concatenated 1-bit hashes of length m
+    # with XOR compression factor N, stored as an (n, words)
+    # array of 64 bit words (most significant word first,
+    # as similarity.pack)
+    # XOR, compressed, digits and hex give the same results
+    # as the corresponding C_hash methods for every hash
+    def __init__(self, words, m, N=1):
+        self.words = np.asarray(words, dtype=np.uint64)
+        if not (self.words.ndim == 2 and self.words.shape[1] == -(-m // 64)):
+            raise ValueError('words must have shape (n, %d)' % -(-m // 64))
+        self.m = m
+        self.N = N
+
+    @classmethod
+    def from_hashes(cls, hashes):
+        # returns an instance holding the C_hash instances in hashes
+        # (which must have equal m and N)
+        hashes = list(hashes)
+        m, N = hashes[0].m, hashes[0].N
+        if not all(h.m == m and h.N == N for h in hashes):
+            raise ValueError('Hashes must have equal m and N')
+        return cls(pack(hashes, m), m, N)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, i):
+        return C_hash(int(hexlify(self.words[i].astype('>u8').tobytes()), 16), self.m, self.N)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def c_hashes(self):
+        # returns a list of C_hash instances
+        return list(self)
+
+    def bits(self):
+        # returns an (n, m) uint8 array of bits
+        # (most significant first)
+        big = np.ascontiguousarray(self.words.astype('>u8')).view(np.uint8)
+        return np.unpackbits(big, axis=1)[:,-self.m:] if self.m else big[:,:0]
+
+    @classmethod
+    def from_bits(cls, bits, N=1):
+        # returns an instance for an (n, m) array of bits
+        # (most significant first)
+        n, m = bits.shape
+        pad = -m % 64
+        padded = np.zeros((n, m + pad), dtype=np.uint8)
+        padded[:,pad:] = bits
+        packed = np.packbits(padded, axis=1)
+        words = packed.view('>u8').astype(np.uint64)
+        return cls(words, m, N)
+
+    def compressed(self, m):
+        # returns the batch of hashes reduced to
+        # the m least significant bits
+        if not m <= self.m:
+            raise ValueError('Cannot compress to larger size')
+        # C_hash.compressed returns hashes with N=1
+        return self.from_bits(self.bits()[:,self.m-m:])
+
+    def XOR(self, N):
+        # returns the batch of hashes compressed by XORing
+        # N chunks (N must be a positive power of 2)
+        if not (N > 0 and N & (N-1) == 0):
+            raise ValueError(' N must be a positive power of 2')
+        chunksize = self.m // N
+        if not N * chunksize == self.m:
+            raise ValueError('Hash size %s not divisible by %s' % (self.m, N))
+        if chunksize % 64 == 0:
+            # whole words can be XORed
+            words = self.words.reshape(len(self), N, -1)
+            return self.__class__(np.bitwise_xor.reduce(words, axis=1), chunksize, self.N*N)
+        bits = self.bits().reshape(len(self), N, chunksize)
+        return self.from_bits(np.bitwise_xor.reduce(bits, axis=1), self.N*N)
+
+    @property
+    def digits(self):
+        # the list of bitstring representations
+        # (a property, as for C_hash)
+        chars = (self.bits() + ord('0')).astype(np.uint8)
+        return [row.tobytes() for row in chars]
+
+    def hex(self):
+        # returns a list of hex representations
+        big = np.ascontiguousarray(self.words.astype('>u8')).view(np.uint8)
+        return ['0x%sL' % (hexlify(row.tobytes()).lstrip('0') or '0') for row in big]
@@ -0,0 +1,164 @@
+
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+from binascii import unhexlify
+
+import numpy as np
+
+import instrument
+from bitstring import popcount_array, hamdist_many, and_popcount
+
+"""
+Bulk similarity computations between two sets of records
+represented by Bloom filters or concatenated hashes.
+
+Bitstrings are packed into (n, words) arrays of 64 bit words (the
+most significant word first) and compared a block of rows at a
+time, with vectorized AND / XOR and population counts (see the
+array functions of bitstring).
+
+The measures are those of the corresponding pairwise functions
+in pseudo: 'bf_jaccard' (J_hat_from_bf), 'bf_dice' (D_hat_from_bf),
+'bf_corrected' (J_hat_from_bf_corrected) and 'conc' (J_hat_from_conc).
+Pairs of empty Bloom filters give nan rather than raising an exception.
+"""
+
+measures = ['bf_jaccard', 'bf_dice', 'bf_corrected', 'conc']
+
+def pack(values, m):
+    # returns an (n, words) uint64 array for the n bitstrings
+    # (Python longs, C_hash or BloomFilter instances) of length m
+    nwords = -(-m // 64)
+    hexes = ['%0*x' % (nwords*16, getattr(v, 'bits', v)) for v in values]
+    buf = unhexlify(''.join(hexes))
+    return np.frombuffer(buf, dtype='>u8').astype(np.uint64).reshape(-1, nwords)
+
+def popcounts(packed):
+    # returns the number of set bits in each row of packed
+    return popcount_array(packed)
+
+def _operands(values, m):
+    # returns packed array and bit-length for
+    # a sequence of bitstrings or a packed array
+    # (for which m must be supplied, as the padding of
+    # the words does not determine it)
+    if isinstance(values, np.ndarray):
+        if m is None:
+            raise ValueError('m must be supplied for packed arrays')
+        if not values.shape[1] == -(-m // 64):
+            raise ValueError('Packed array does not hold bitstrings of length %d' % m)
+        return values, m
+    values = list(values)
+    if m is None:
+        try:
+            m = values[0].m
+        except (IndexError, AttributeError):
+            raise ValueError('m must be supplied for plain bitstrings')
+    return pack(values, m), m
+
+def _scores(a, b, pa, pb, measure, m, N, truncate):
+    # returns the matrix of scores for packed blocks a and b
+    # (with row popcounts pa and pb)
+    if measure == 'conc':
+        d = hamdist_many(a[:,None,:], b[None,:,:])
+        res = 1 - 2 * d / m
+        if truncate or N > 1:
+            res = np.maximum(res, 0)
+        if N > 1:
+            res = res ** (1/N)
+        return res
+    inter = and_popcount(a[:,None,:], b[None,:,:])
+    union = pa[:,None] + pb[None,:] - inter
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if measure == 'bf_jaccard':
+            return inter / union
+        if measure == 'bf_dice':
+            return 2 * inter / (pa[:,None] + pb[None,:])
+        if measure == 'bf_corrected':
+            A = -m * np.log(1 - pa / m)
+            B = -m * np.log(1 - pb / m)
+            AB = -m * np.log(1 - union / m)
+            num = np.maximum(A[:,None] + B[None,:] - AB, 0)
+            denom = np.minimum(AB, A[:,None] + B[None,:])
+            return num / denom
+    raise ValueError('Unknown measure %s' % measure)
+
+def blocks(A, B, measure='bf_jaccard', m=None, N=None, truncate=True, block_words=2**16):
+    # returns a generator of (i, j, scores) tuples where scores is
+    # the matrix of scores between the records in A starting at
+    # index i and the records in B starting at index j
+    # A and B are sequences of bitstrings (or packed arrays)
+    # m is the bit-length (by default the m attribute of the first
+    # record of A, and required if A is a packed array), and N the
+    # XOR compression factor of concatenated hashes (by default
+    # the N attribute)
+    # blocks are sized to hold about block_words words
+    if N is None:
+        N = getattr(A[0], 'N', 1) if len(A) else 1
+    a_packed, m = _operands(A, m)
+    b_packed, _ = _operands(B, m)
+    if not measure in measures:
+        raise ValueError('Unknown measure %s' % measure)
+    nwords = a_packed.shape[1]
+    rows = max(1, int((block_words / nwords) ** 0.5))
+    pa = popcounts(a_packed)
+    pb = popcounts(b_packed)
+    for i in range(0, len(a_packed), rows):
+        for j in range(0, len(b_packed), rows):
+            a, b = a_packed[i:i+rows], b_packed[j:j+rows]
+            with instrument.timed('compare', len(a) * len(b)):
+                scores = _scores(a, b, pa[i:i+rows], pb[j:j+rows], measure, m, N, truncate)
+            yield i, j, scores
+
+def matrix(A, B, measure='bf_jaccard', m=None, N=None, truncate=True, block_words=2**16):
+    # returns the dense (len(A), len(B)) matrix of scores
+    res = np.empty((len(A), len(B)))
+    for i, j, scores in blocks(A, B, measure, m, N, truncate, block_words):
+        res[i:i+scores.shape[0],j:j+scores.shape[1]] = scores
+    return res
+
+def above_threshold(A, B, threshold, measure='bf_jaccard', m=None, N=None,
+                    truncate=True, block_words=2**16):
+    # returns a generator of (i, j, score) tuples for the pairs
+    # of records with scores not less than threshold
+    for i, j, scores in blocks(A, B, measure, m, N, truncate, block_words):
+        for r, c in zip(*np.nonzero(scores >= threshold)):
+            yield i + r, j + c, scores[r,c]
+
+def top_k(A, B, k, measure='bf_jaccard', m=None, N=None, truncate=True, block_words=2**16):
+    # returns a list containing, for each record in A, a list of
+    # (j, score) tuples for the k highest scoring records in B
+    # in decreasing order of score (ties in order of j)
+    best_scores = np.full((len(A), k), -np.inf)
+    best_inds = np.full((len(A), k), -1, dtype=np.int64)
+    for i, j, scores in blocks(A, B, measure, m, N, truncate, block_words):
+        n, nb = scores.shape
+        rows = slice(i, i + n)
+        cand_scores = np.hstack([best_scores[rows], np.nan_to_num(scores)])
+        cand_inds = np.hstack([best_inds[rows], np.tile(np.arange(j, j + nb), (n, 1))])
+        order = np.argsort(-cand_scores, axis=1, kind='mergesort')[:,:k]
+        keep = np.arange(n).reshape(-1, 1)
+        best_scores[rows] = cand_scores[keep,order]
+        best_inds[rows] = cand_inds[keep,order]
+    return [[(int(j), score) for j, score in zip(inds, scores) if j >= 0]
+            for inds, scores in zip(best_inds, best_scores)]
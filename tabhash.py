@@ -21,10 +21,15 @@
 
 from __future__ import division
 
-from hashlib import md5
+import functools
+import struct
 
 import numpy as np
 
+import digest
+import instrument
+from cache import BoundedCache
+
 
 class SimpleTabulation(object):
     # simple tabulation hash for variable
@@ -33,31 +38,315 @@ class SimpleTabulation(object):
     # admissible hash lengths are 8, 16, 32 and 64
     sizes = [8, 16, 32, 64]
     int_types = {8:np.uint8, 16:np.uint16, 32:np.uint32, 64:np.uint64}
+    # callable returning the cache for string hashes
+    # (set to cache.NullCache to disable caching)
+    cache_factory = functools.partial(BoundedCache, maxsize=2**14)
+    # table of intermediate keys (md5 digests)
+    digests = digest.shared
+    # if False, then q=64 keys are split into table indices as by
+    # earlier versions (see legacy_key_bytes), so that hashes stored
+    # by them remain valid (see ExactTabulation)
+    exact_keys = False
     def __init__(self, q=64, seed=None):
-        # if seed is not None, then its value will
-        # be used to seed the PRNG
+        # if seed is not None, then the tables are generated
+        # from the stream random_stream(seed), otherwise
+        # from a fresh (OS seeded) numpy PRNG
         # q denotes bit-length of hash returned by the hash method
         if not q in self.sizes:
             raise ValueError ('Invalid parameter value for q')
         self.q = q
         self.int_type = self.int_types[q]
-        if not seed is None:
-            np.random.seed(seed)
-        if self.q == 64:
-            self.tables = (np.random.random_integers(0, 2**32-1, size=(8, 256)).astype(np.uint64) +
-                           (np.random.random_integers(0, 2**32-1, size=(8, 256)).astype(np.uint64) << 32))
-        else:
-            self.tables = np.random.random_integers(0, 2**q-1, size=(self.q//8, 256)).astype(self.int_type)
-        self._cache = {}
+        rng = np.random.RandomState() if seed is None else random_stream(seed)
+        self.tables = random_tables(q, rng)
+        self._cache = self.cache_factory()
+        instrument.register_cache('SimpleTabulation', self._cache)
+
+    @classmethod
+    def from_seed(cls, q, seed, *path):
+        # returns an instance whose tables are generated from
+        # the stream random_stream(seed, *path), independent
+        # of the streams for other paths
+        return cls.from_tables(random_tables(q, random_stream(seed, *path)))
+
+    @classmethod
+    def from_tables(cls, tables):
+        # returns an instance using the given (q//8, 256)
+        # array of tables (which is not copied)
+        obj = cls.__new__(cls)
+        q = tables.shape[0] * 8
+        if not (q in cls.sizes and tables.shape[1] == 256):
+            raise ValueError ('Invalid shape for tables')
+        obj.q = q
+        obj.int_type = cls.int_types[q]
+        obj.tables = np.asarray(tables, dtype=obj.int_type)
+        obj._cache = obj.cache_factory()
+        instrument.register_cache('SimpleTabulation', obj._cache)
+        return obj
+
+    @classmethod
+    def from_key(cls, q, arrays):
+        # returns an instance with hash size q for a dict
+        # of key arrays (as returned by key_arrays)
+        if not arrays['tables'].shape[0] == q//8:
+            raise ValueError('Key material does not match parameters')
+        return cls.from_tables(arrays['tables'])
+
+    def key_arrays(self):
+        # returns a dict of the arrays from which
+        # the hash function is constructed
+        return {'tables': self.tables}
+
+    @property
+    def cache(self):
+        return self._cache
 
     def hash(self, s):
-        if not s in self._cache:
-            x = self.int_type(int(md5(s).hexdigest(), 16) >> (128-self.q))
-            h = self.int_type(0)
-            for i in range(self.tables.shape[0]):
-                c = np.uint8(x)
-                h ^= self.tables[i,c]
-                #x = x >> 8
-                x = self.int_type(x//256) # bit shifting exposes bug in numpy for 64 bit unsigned int
-            self._cache[s] = int(h)
-        return self._cache[s]
+        # the token is digested directly rather than interned
+        # in the digest table, which only pays for batches
+        h = self._cache.get(s)
+        if h is None:
+            h = self._hash_key(self.digests.key_of(s, self.q))
+            self._cache[s] = h
+        return h
+
+    def hash_id(self, i):
+        # returns the hash of the token with id i
+        # in the digest table
+        return self._hash_key(self.digests.key(i, self.q))
+
+    def _hash_key(self, key):
+        # returns the hash of the intermediate key bytes key
+        # byte j (least significant first) indexes table j
+        # (the tables are looked up as lists of Python ints)
+        try:
+            rows = self._rows
+        except AttributeError:
+            rows = self._rows = self.tables.tolist()
+        if self.q == 64 and not self.exact_keys:
+            key = _legacy_key(key)
+        h = 0
+        for row, c in zip(rows, key):
+            h ^= row[c]
+        return h
+
+    def hash_many(self, strings):
+        # returns an array (of type self.int_type) containing
+        # the hashes of the strings in the sequence strings,
+        # with all table lookups done as whole-array operations
+        # results are identical to those returned by the hash method
+        return self.hash_ids(self.digests.ids(strings))
+
+    def hash_ids(self, ids):
+        # returns an array of the hashes for an
+        # array of token ids in the digest table
+        return self.tabulate(self.digests.key_bytes(ids, self.q))
+
+    def tabulate(self, keys):
+        # returns the hashes for an (n, q//8) array of
+        # intermediate key bytes (as returned by key_bytes)
+        keys = np.asarray(keys, dtype=np.uint8)
+        if self.q == 64 and not self.exact_keys:
+            keys = legacy_key_bytes(keys)
+        with instrument.timed('tabulate', len(keys)):
+            cols = np.arange(self.tables.shape[0])
+            return np.bitwise_xor.reduce(self.tables[cols,keys], axis=1)
+
+
+
+class ExactTabulation(SimpleTabulation):
+    # simple tabulation indexing the tables of a q=64 hash with
+    # the exact bytes of the intermediate key, rather than those
+    # of the key rounded to 53 significant bits (see legacy_key_bytes)
+    # hashes with q < 64 are those of SimpleTabulation
+    # its q=64 hashes differ from those of SimpleTabulation for most
+    # tokens, so switching to it means rehashing stored data (and
+    # saving a new key file, which records the family)
+    exact_keys = True
+
+
+def _legacy_key(key):
+    # scalar version of legacy_key_bytes for a single key
+    # (a bytearray of 8 bytes, least significant first)
+    x, = struct.unpack('<Q', bytes(key))
+    x = ((int(float(x) / 256) << 8) | (x & 255)) & 0xffffffffffffffff
+    return bytearray(struct.pack('<Q', x))
+
+def legacy_key_bytes(keys):
+    # returns the (n, 8) uint8 array of the bytes that index the
+    # tables of a q=64 SimpleTabulation, for an array of intermediate
+    # key bytes (as returned by key_bytes)
+    # the original implementation shifted the key with x//256 on
+    # numpy uint64 scalars, which numpy promotes to float64, so that
+    # after the first byte the key is rounded to 53 significant bits
+    keys = np.ascontiguousarray(keys, dtype=np.uint8)
+    x = keys.view('<u8')[:,0]
+    rounded = np.floor(x.astype(np.float64) / 256).astype(np.uint64)
+    x = (rounded << np.uint64(8)) | (x & np.uint64(255))
+    return x.astype('<u8').view(np.uint8).reshape(-1, 8)
+
+def random_stream(seed, *path):
+    # returns a numpy RandomState for the stream identified by a
+    # non-negative integer seed and a path of non-negative integers
+    # (e.g. the index of a hash function), seeded with their 32 bit
+    # words (so that distinct (seed, path) give independent streams)
+    words = []
+    for x in (seed,) + path:
+        x = int(x)
+        if x < 0:
+            raise ValueError('Seeds must be non-negative')
+        n = 0
+        while True:
+            words.append(x & 0xffffffff)
+            n += 1
+            x >>= 32
+            if not x:
+                break
+        words.append(n)
+    return np.random.RandomState(words)
+
+def new_seed():
+    # returns a seed drawn from a fresh (OS seeded) numpy PRNG
+    # (the global numpy PRNG is neither used nor reseeded)
+    return int(np.random.RandomState().randint(0, 2**32, dtype=np.uint64))
+
+def random_tables(q, rng):
+    # returns a (q//8, 256) array of random q bit table
+    # entries drawn from rng (a RandomState)
+    int_type = SimpleTabulation.int_types[q]
+    return rng.randint(0, 2**q, size=(q//8, 256), dtype=int_type)
+
+def key_bytes(strings, q=64):
+    # returns an (n, q//8) uint8 array of the md5 intermediate
+    # keys for the n strings in strings
+    # column i holds byte i of the key, least significant byte first,
+    # i.e. the byte that indexes table i of a SimpleTabulation
+    # (for q=64, of an ExactTabulation)
+    return digest.shared.key_bytes(digest.shared.ids(strings), q)
+
+class LazyHashers(object):
+    # sequence of the hashers klass.from_seed(q, seed, 0, i)
+    # for i in indices (by default range(m)), i.e. with tables
+    # from independent streams, each constructed on first access
+    def __init__(self, klass, q, seed, m=None, indices=None):
+        self.klass = klass
+        self.q = q
+        self.seed = seed
+        self.indices = list(range(m) if indices is None else indices)
+        self._hashers = {}
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(len(self))[i]]
+        if i < 0:
+            i += len(self)
+        h = self._hashers.get(i)
+        if h is None:
+            h = self._hashers[i] = self.klass.from_seed(self.q, self.seed, 0, self.indices[i])
+        return h
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def subset(self, start, stop):
+        # returns an instance for indices[start:stop]
+        # sharing the hashers already constructed
+        res = self.__class__(self.klass, self.q, self.seed, indices=self.indices[start:stop])
+        for i, h in self._hashers.items():
+            if start <= i < stop:
+                res._hashers[i - start] = h
+        return res
+
+    @property
+    def constructed(self):
+        # number of hashers constructed
+        return len(self._hashers)
+
+
+def index_tokens(token_sets):
+    # returns the list of distinct strings in the token sets
+    # in token_sets, a list of their indices in this list
+    # for the concatenated token sets, and a list of the
+    # offsets at which each token set starts
+    index = {}
+    cols = []
+    offsets = []
+    for tokens in token_sets:
+        if not tokens:
+            raise ValueError('Cannot hash an empty token set')
+        offsets.append(len(cols))
+        for s in tokens:
+            cols.append(index.setdefault(s, len(index)))
+    strings = sorted(index, key=index.get)
+    return strings, cols, offsets
+
+
+class StackedTabulation(object):
+    # m simple tabulation hashes with their tables stacked
+    # in a single (m, q//8, 256) array, so that all m hashes
+    # of many strings can be computed with vectorized lookups
+    # (the hashes are those of SimpleTabulation)
+    def __init__(self, tables):
+        # tables is an (m, q//8, 256) array of unsigned integers
+        self.tables = np.asarray(tables)
+        self.q = self.tables.shape[1] * 8
+        if not self.q in SimpleTabulation.sizes:
+            raise ValueError ('Invalid shape for tables')
+        self.int_type = SimpleTabulation.int_types[self.q]
+
+    @classmethod
+    def from_hashers(cls, hashers):
+        # returns an instance stacking the tables of the
+        # SimpleTabulation instances in hashers, which
+        # thereafter share (views of) the stacked tables
+        obj = cls(np.array([h.tables for h in hashers]))
+        for h, tables in zip(hashers, obj.tables):
+            h.tables = tables
+        return obj
+
+    @property
+    def m(self):
+        return self.tables.shape[0]
+
+    def hash_many(self, strings):
+        # returns an (m, n) array of the m hashes
+        # of each of the n strings in strings
+        return self.hash_ids(digest.shared.ids(strings))
+
+    def hash_ids(self, ids):
+        # returns an (m, n) array of the m hashes of
+        # each of the n token ids in the digest table
+        return self.tabulate(digest.shared.key_bytes(ids, self.q))
+
+    def tabulate(self, keys):
+        # returns the (m, n) array of hashes for an (n, q//8)
+        # array of intermediate key bytes (as returned by key_bytes)
+        keys = np.asarray(keys, dtype=np.uint8)
+        if self.q == 64:
+            keys = legacy_key_bytes(keys)
+        with instrument.timed('tabulate', self.m * len(keys)):
+            h = self.tables[:,0,keys[:,0]]
+            for i in range(1, keys.shape[1]):
+                h ^= self.tables[:,i,keys[:,i]]
+            return h
+
+    def min_hash(self, tokens):
+        # returns an array of the m minimum
+        # hashes over the strings in tokens
+        if not tokens:
+            raise ValueError('Cannot hash an empty token set')
+        return self.hash_many(list(tokens)).min(axis=1)
+
+    def min_hash_many(self, token_sets):
+        # returns an (n, m) array of the minimum hashes over
+        # each of the n token sets in token_sets
+        # each distinct token is hashed once per batch
+        strings, cols, offsets = index_tokens(token_sets)
+        if not offsets:
+            return np.empty((0, self.m), dtype=self.int_type)
+        hashes = self.hash_many(strings)
+        with instrument.timed('min-reduce', len(offsets)):
+            return np.minimum.reduceat(hashes[:,cols], offsets, axis=1).T
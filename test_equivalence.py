@@ -0,0 +1,357 @@
+##Copyright (c) 2014 duncan g. smith
+##
+##Permission is hereby granted, free of charge, to any person obtaining a
+##copy of this software and associated documentation files (the "Software"),
+##to deal in the Software without restriction, including without limitation
+##the rights to use, copy, modify, merge, publish, distribute, sublicense,
+##and/or sell copies of the Software, and to permit persons to whom the
+##Software is furnished to do so, subject to the following conditions:
+##
+##The above copyright notice and this permission notice shall be included
+##in all copies or substantial portions of the Software.
+##
+##THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+##OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+##FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+##THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+##OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+##ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+##OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import division
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import keyfile
+import mih
+import sigfile
+import similarity
+from bitstring import hamdist
+from cache import NullCache
+from families import families
+from pseudo import (Minwise, B_bit, Concatenated, OP_B_bit, OP_Concatenated, C_hash,
+                    J_hat, J_hat_from_conc, J_hat_from_bf, D_hat_from_bf,
+                    J_hat_from_bf_corrected)
+from set_like import k_hashes, BloomFilter, ArrayBloomFilter, CountingBloomFilter
+from signatures import BbitSignatures, CHashBatch
+from tabhash import SimpleTabulation, StackedTabulation
+from tokenization import n_grams
+
+"""
+Tests of the equivalences the batch and array implementations rely on:
+each fast path must give the results of the corresponding scalar
+function, and hashes must match those of the original implementation
+(frozen below).
+
+Run with python -m unittest test_equivalence (or python test_equivalence.py).
+"""
+
+TOKENS = ['', 'a', 'jo', 'smith', '\xff\x00\x80', 'm\xc3\xbcller', 'x' * 100]
+
+# hashes of TOKENS by the original SimpleTabulation, with the tables
+# of _lcg_tables(q, q)
+BASELINE = {
+    8: [30, 237, 220, 13, 177, 237, 30],
+    16: [29474, 22583, 60212, 4561, 41225, 18082, 62321],
+    32: [1651637727, 3687386086, 4014987485, 2734566920, 973417517, 4234248843, 701197449],
+    64: [6235316143924155583, 6045832119818380066, 15126705603234719481,
+         3262699642851439317, 18103305762086747051, 16420873807696022684,
+         9851248117860369030]}
+
+# minwise hashes by the original Minwise (m=3) of the token sets in
+# BASELINE_SETS, hasher i having the tables of _lcg_tables(64, 100 + i)
+BASELINE_SETS = [['jo', 'sm', 'mi'], ['a'], TOKENS]
+BASELINE_MINWISE = [[5002782060371526987, 6413853024609695801, 10848785880107294329],
+                    [6136582903203243778, 16452179076370327254, 3283345168094182],
+                    [196597129874085933, 7692997962666771376, 3283345168094182]]
+
+def _lcg_tables(q, stream):
+    # returns a (q//8, 256) list of q bit table entries from a
+    # 64 bit linear congruential generator (independent of numpy)
+    x = stream
+    rows = []
+    for i in range(q // 8):
+        row = []
+        for c in range(256):
+            x = (6364136223846793005 * x + 1442695040888963407) % 2**64
+            row.append(x >> (64 - q))
+        rows.append(row)
+    return rows
+
+def _names(count, seed):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('abcdefg') for _ in range(rng.randint(3, 9)))
+            for _ in range(count)]
+
+def _token_sets(count, seed=0):
+    return [n_grams(name, 2, True) for name in _names(count, seed)]
+
+
+class BaselineTest(unittest.TestCase):
+    # hashes must match those of the original implementation
+
+    def test_simple_tabulation(self):
+        for q, expected in sorted(BASELINE.items()):
+            tables = np.array(_lcg_tables(q, q), dtype=SimpleTabulation.int_types[q])
+            h = SimpleTabulation.from_tables(tables)
+            self.assertEqual([h.hash(s) for s in TOKENS], expected)
+            self.assertEqual(h.hash_many(TOKENS).tolist(), expected)
+            stacked = StackedTabulation(np.array([tables, tables]))
+            self.assertEqual(stacked.hash_many(TOKENS).tolist(), [expected, expected])
+
+    def test_minwise(self):
+        tables = np.array([_lcg_tables(64, 100 + i) for i in range(3)], dtype=np.uint64)
+        for stacked in [False, True]:
+            mw = Minwise(3, key={'tables': tables}, stacked=stacked)
+            sets = [frozenset(t) for t in BASELINE_SETS]
+            self.assertEqual([mw.hash(t) for t in sets], BASELINE_MINWISE)
+            self.assertEqual([list(h) for h in mw.hash_many(sets)], BASELINE_MINWISE)
+
+
+class BatchHashTest(unittest.TestCase):
+    # batch hashing must give the hashes of the scalar methods
+
+    def test_families(self):
+        strings = TOKENS + ['t%d' % i for i in range(300)]
+        for name, klass in sorted(families.items()):
+            for q in klass.sizes:
+                h = klass.from_seed(q, 5, 0)
+                expected = [h.hash(s) for s in strings]
+                self.assertEqual([int(x) for x in h.hash_many(strings)], expected, (name, q))
+
+    def test_minwise_classes(self):
+        token_sets = _token_sets(80)
+        for make in [lambda **kw: Minwise(20, seed=1, **kw),
+                     lambda **kw: Minwise(20, q=16, seed=1, **kw),
+                     lambda **kw: B_bit(2, 30, seed=2, **kw),
+                     lambda **kw: Concatenated(100, seed=3, **kw)]:
+            plain = make()
+            scalar = [plain.hash(t) for t in token_sets]
+            self.assertEqual(list(make().hash_many(token_sets)), scalar)
+            self.assertEqual(list(make(stacked=True).hash_many(token_sets)), scalar)
+            self.assertEqual([make(stacked=True).hash(t) for t in token_sets], scalar)
+        for name in sorted(families):
+            c = Concatenated(64, seed=4, klass=name)
+            self.assertEqual(list(c.hash_many(token_sets)), [c.hash(t) for t in token_sets], name)
+
+    def test_one_permutation(self):
+        token_sets = _token_sets(80)
+        for h in [OP_B_bit(2, 64, seed=1), OP_Concatenated(128, seed=2)]:
+            self.assertEqual(list(h.hash_many(token_sets)), [h.hash(t) for t in token_sets])
+
+    def test_hash_array(self):
+        token_sets = _token_sets(40)
+        h = B_bit(3, 50, seed=1, stacked=True)
+        self.assertEqual(h.hash_array(token_sets).tolist(), h.hash_many(token_sets))
+
+
+class IncrementalTest(unittest.TestCase):
+    # an IncrementalHash must match a fresh hash of its tokens
+
+    def test_add_remove(self):
+        rng = random.Random(1)
+        pool = ['t%d' % i for i in range(60)]
+        for hasher in [Minwise(40, seed=1), B_bit(2, 40, seed=2, stacked=True),
+                       Concatenated(100, seed=3), OP_Concatenated(64, seed=4)]:
+            tokens = set(rng.sample(pool, 5))
+            inc = hasher.incremental(tokens)
+            for step in range(150):
+                if rng.random() < 0.5 or len(tokens) < 3:
+                    change = set(rng.sample(pool, rng.randint(1, 3)))
+                    tokens |= change
+                    inc.add(change)
+                else:
+                    change = set(rng.sample(sorted(tokens), rng.randint(1, 2)))
+                    tokens -= change
+                    inc.remove(change)
+                # fresh hash, bypassing the hasher's cache
+                fresh = hasher.__class__.__new__(hasher.__class__)
+                fresh.__dict__.update(hasher.__dict__)
+                fresh._cache = NullCache()
+                self.assertEqual(inc.tokens, frozenset(tokens))
+                self.assertEqual(inc.hash(), fresh.hash(tokens))
+
+
+class BloomFilterTest(unittest.TestCase):
+    # array and counting Bloom filters must hold the bits of BloomFilter
+
+    def test_bits(self):
+        token_sets = _token_sets(30)
+        for m, k in [(5, 1), (100, 3), (1003, 7)]:
+            funcs = k_hashes(k, m, seed=2)
+            plain_funcs = [lambda x, f=f: f(x) for f in funcs]
+            for tokens in token_sets:
+                expected = BloomFilter(m, funcs, tokens).bits
+                batch = BloomFilter(m, funcs)
+                batch.add_many(tokens)
+                self.assertEqual(batch.bits, expected)
+                self.assertEqual(ArrayBloomFilter(m, funcs, tokens).bits, expected)
+                self.assertEqual(ArrayBloomFilter(m, plain_funcs, tokens).bits, expected)
+                self.assertEqual(CountingBloomFilter(m, funcs, tokens).bits, expected)
+                arr = ArrayBloomFilter(m, funcs)
+                for token in tokens:
+                    arr.add(token)
+                self.assertEqual(arr.bits, expected)
+
+    def test_counting_remove(self):
+        pool = ['t%d' % i for i in range(40)]
+        funcs = k_hashes(5, 200, seed=3)
+        counting = CountingBloomFilter(200, funcs, pool[:20])
+        counting.remove_many(pool[:10])
+        counting.add('x')
+        counting.remove('x')
+        self.assertEqual(counting.bits, BloomFilter(200, funcs, pool[10:20]).bits)
+        self.assertRaises(ValueError, counting.remove_many, pool[30:40])
+
+
+class SimilarityTest(unittest.TestCase):
+    # similarity and BbitSignatures must give the scores
+    # of the scalar estimators
+
+    def test_bloom_measures(self):
+        token_sets = _token_sets(50)
+        funcs = k_hashes(4, 500, seed=2)
+        bfs = [BloomFilter(500, funcs, t) for t in token_sets]
+        A, B = bfs[:20], bfs[20:]
+        for measure, func in [('bf_jaccard', J_hat_from_bf), ('bf_dice', D_hat_from_bf),
+                              ('bf_corrected', lambda a, b: J_hat_from_bf_corrected(a, b, 500))]:
+            expected = np.array([[func(a.bits, b.bits) for b in B] for a in A])
+            scores = similarity.matrix(A, B, measure, block_words=100)
+            self.assertTrue(np.allclose(scores, expected, rtol=0, atol=1e-12), measure)
+            packed = similarity.matrix(similarity.pack(A, 500), similarity.pack(B, 500),
+                                       measure, m=500)
+            self.assertTrue(np.allclose(packed, expected, rtol=0, atol=1e-12), measure)
+
+    def test_conc(self):
+        hashes = Concatenated(200, seed=1, stacked=True).hash_many(_token_sets(50))
+        for N in [1, 2, 4]:
+            H = [h.XOR(N) for h in hashes] if N > 1 else hashes
+            m = 200 // N
+            for truncate in [True, False]:
+                expected = np.array([[J_hat_from_conc(a, b, m, N, truncate) for b in H[20:]]
+                                     for a in H[:20]])
+                scores = similarity.matrix(H[:20], H[20:], 'conc', truncate=truncate,
+                                           block_words=50)
+                self.assertTrue(np.allclose(scores, expected, rtol=0, atol=1e-12), (N, truncate))
+                packed = similarity.matrix(similarity.pack(H[:20], m), similarity.pack(H[20:], m),
+                                           'conc', m=m, N=N, truncate=truncate)
+                self.assertTrue(np.allclose(packed, expected, rtol=0, atol=1e-12), (N, truncate))
+        self.assertRaises(ValueError, similarity.matrix, similarity.pack(hashes, 200),
+                          similarity.pack(hashes, 200), 'conc')
+
+    def test_bbit(self):
+        token_sets = _token_sets(40)
+        for b, m in [(1, 64), (2, 100), (3, 7)]:
+            hashes = B_bit(b, m, seed=2, stacked=True).hash_many(token_sets)
+            signatures = BbitSignatures(hashes, b)
+            self.assertEqual(signatures.values().tolist(), hashes)
+            expected = np.array([[J_hat(x, y, b) for y in hashes[:15]] for x in hashes])
+            scores = signatures.J_hat_many(BbitSignatures(hashes[:15], b), block_words=20)
+            self.assertTrue(np.allclose(scores, expected, atol=1e-12), (b, m))
+            self.assertTrue(np.allclose(signatures.J_hat_one(hashes[0]), expected[:,0], atol=1e-12))
+
+
+class CHashBatchTest(unittest.TestCase):
+    # CHashBatch must give the results of the C_hash methods
+
+    def test_methods(self):
+        rng = random.Random(5)
+        for m in [1, 8, 64, 100, 128, 130, 256]:
+            hashes = ([C_hash(rng.getrandbits(m), m) for _ in range(30)] +
+                      [C_hash(0, m), C_hash(2**m - 1, m)])
+            batch = CHashBatch.from_hashes(hashes)
+            self.assertEqual(batch.c_hashes(), hashes)
+            self.assertEqual(batch.digits, [h.digits for h in hashes])
+            self.assertEqual(batch.hex(), [h.hex() for h in hashes])
+            for N in [2, 4, 8]:
+                if m % N == 0:
+                    xored = batch.XOR(N)
+                    self.assertEqual(xored.c_hashes(), [h.XOR(N) for h in hashes], (m, N))
+                    self.assertEqual(xored.N, N)
+            for size in sorted(set([1, m // 2 or 1, m])):
+                self.assertEqual(batch.compressed(size).c_hashes(),
+                                 [h.compressed(size) for h in hashes], (m, size))
+
+
+class FileTest(unittest.TestCase):
+    # signature and key files must round trip
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_sigfile(self):
+        token_sets = _token_sets(30)
+        path = os.path.join(self.dir, 'signatures')
+        hashes = Concatenated(130, seed=1).hash_many(token_sets)
+        sigfile.write(path, 'conc', hashes[:10], 130)
+        sigfile.append(path, CHashBatch.from_hashes(hashes[10:20]))
+        sigfile.append(path, similarity.pack(hashes[20:], 130))
+        for mmap in [True, False]:
+            loaded = sigfile.load(path, mmap=mmap)
+            self.assertEqual(loaded.c_hashes(), hashes)
+            self.assertEqual(loaded.batch().c_hashes(), hashes)
+        other = Concatenated(120, seed=1).hash_many(token_sets)
+        self.assertRaises(ValueError, sigfile.append, path, other)
+        self.assertRaises(ValueError, sigfile.append, path, similarity.pack(other, 128))
+        bbit = B_bit(3, 70, seed=1).hash_many(token_sets)
+        sigfile.write(path, 'bbit', BbitSignatures(bbit[:10], 3), 70, b=3)
+        sigfile.append(path, bbit[10:])
+        self.assertEqual(sigfile.load(path).bbit().values().tolist(), bbit)
+        funcs = k_hashes(3, 200, seed=2)
+        bfs = [BloomFilter(200, funcs, t) for t in token_sets]
+        sigfile.write(path, 'bloom', bfs, 200)
+        self.assertEqual(sigfile.load(path).bits(), [bf.bits for bf in bfs])
+
+    def test_keyfile(self):
+        token_sets = _token_sets(30)
+        path = os.path.join(self.dir, 'key')
+        for hasher in [Concatenated(64, seed=1), B_bit(2, 40, seed=2, klass='TwistedTabulation'),
+                       Minwise(10, q=32, seed=3, klass='KeyedTabulation'),
+                       OP_Concatenated(64, seed=4)]:
+            expected = [hasher.hash(t) for t in token_sets]
+            keyfile.save(hasher, path)
+            for stacked in [False, True]:
+                loaded = keyfile.load(path, stacked=stacked)
+                self.assertEqual([loaded.hash(t) for t in token_sets], expected)
+                self.assertEqual(keyfile.fingerprint(loaded), keyfile.fingerprint(hasher))
+        funcs = k_hashes(5, 1000, seed=1)
+        keyfile.save(funcs, path)
+        loaded = keyfile.load(path)
+        self.assertEqual([[f(s) for f in loaded] for s in TOKENS],
+                         [[f(s) for f in funcs] for s in TOKENS])
+
+
+class MIHTest(unittest.TestCase):
+    # multi-index hashing queries must give the brute force results
+
+    def test_queries(self):
+        hashes = Concatenated(128, seed=3, stacked=True).hash_many(_token_sets(200))
+        for N in [1, 2]:
+            H = [h.XOR(N) for h in hashes] if N > 1 else hashes
+            m = 128 // N
+            index = mih.MIHIndex(m, N=N, hashes=H)
+            for q in range(0, 200, 23):
+                query = H[q]
+                for R in [0, 5, 20]:
+                    expected = sorted((i, hamdist(query, h)) for i, h in enumerate(H)
+                                      if hamdist(query, h) <= R)
+                    self.assertEqual(sorted(index.radius_query(query, R)), expected)
+                for threshold in [0.5, 0.8]:
+                    expected = sorted((i, J_hat_from_conc(query, h, m, N)) for i, h in enumerate(H)
+                                      if J_hat_from_conc(query, h, m, N) >= threshold)
+                    self.assertEqual(sorted(index.threshold_query(query, threshold)), expected)
+                distances = sorted(hamdist(query, h) for h in H)
+                self.assertEqual([d for _, d in index.knn(query, 5)], distances[:5])
+
+
+if __name__ == '__main__':
+    unittest.main()
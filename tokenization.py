@@ -35,3 +35,19 @@ def positional_n_grams(s, n, pad=False):
         s = '_' * (n-1) + s + '_' * (n-1)
     return [(s[i:i+n], i) for i in range(len(s)-n+1)]
                        
+
+def iter_n_grams(s, n, pad=False):
+    # returns a generator of n-grams
+    # (lazy version of n_grams)
+    if pad:
+        s = '_' * (n-1) + s + '_' * (n-1)
+    for i in range(len(s)-n+1):
+        yield s[i:i+n]
+
+def iter_positional_n_grams(s, n, pad=False):
+    # returns a generator of (n-gram, position) tuples
+    # (lazy version of positional_n_grams)
+    if pad:
+        s = '_' * (n-1) + s + '_' * (n-1)
+    for i in range(len(s)-n+1):
+        yield s[i:i+n], i